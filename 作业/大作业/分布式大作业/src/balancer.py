@@ -0,0 +1,64 @@
+import time
+import threading
+import collections
+from contextlib import contextmanager
+from xmlrpc.client import ProtocolError
+from config import latency_ewma_alpha, hedge_percentile, hedge_min_samples, hedge_delay, failure_cooldown
+
+
+class ReplicaSelector(object):
+    def __init__(self, alpha, percentile, min_samples, default_deadline, cooldown):
+        self.alpha = alpha
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.default_deadline = default_deadline
+        self.cooldown = cooldown
+        self.latencies = {}
+        self.in_flight = collections.Counter()
+        self.failed_at = {}
+        self.samples = collections.deque(maxlen=256)
+        self.lock = threading.Lock()
+
+    def rank(self, addresses):
+        now = time.monotonic()
+        with self.lock:
+            scores = {address: (now - self.failed_at.get(address, now - self.cooldown - 1) <= self.cooldown,
+                                self.latencies.get(address, 0.0) * (1 + self.in_flight[address]))
+                      for address in addresses}
+        return sorted(addresses, key=lambda address: scores[address])
+
+    def get_deadline(self):
+        with self.lock:
+            samples = sorted(self.samples)
+        if len(samples) < self.min_samples:
+            return self.default_deadline
+        return samples[min(len(samples) - 1, len(samples) * self.percentile // 100)]
+
+    def record(self, address, latency):
+        with self.lock:
+            previous = self.latencies.get(address)
+            self.latencies[address] = latency if previous is None else \
+                self.alpha * latency + (1 - self.alpha) * previous
+            self.samples.append(latency)
+            self.failed_at.pop(address, None)
+
+    @contextmanager
+    def track(self, address):
+        with self.lock:
+            self.in_flight[address] += 1
+        started = time.perf_counter()
+        try:
+            yield
+        except (OSError, ProtocolError):
+            with self.lock:
+                self.failed_at[address] = time.monotonic()
+            raise
+        else:
+            self.record(address, time.perf_counter() - started)
+        finally:
+            with self.lock:
+                self.in_flight[address] -= 1
+
+
+replica_selector = ReplicaSelector(latency_ewma_alpha, hedge_percentile, hedge_min_samples, hedge_delay,
+                                   failure_cooldown)
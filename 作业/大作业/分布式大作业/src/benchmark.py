@@ -0,0 +1,604 @@
+import os
+import sys
+import time
+import socket
+import signal
+import sqlite3
+import argparse
+import itertools
+import tempfile
+import threading
+import contextlib
+import subprocess
+import multiprocessing
+from pathlib import Path
+from xmlrpc.client import Binary, Fault, ProtocolError
+from xmlrpc.server import SimpleXMLRPCServer
+from config import transport, name_server_urls
+from transport import BinaryRPCServer, connect, get_server_url
+from pool import proxy_pool
+from shards import ShardedProxy, ReplicaGroup, get_user_shard, get_username_shard
+
+src_dir = Path(__file__).resolve().parent
+
+
+class CountingRelay(object):
+    def __init__(self, target_address):
+        self.target_address = target_address
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(('localhost', 0))
+        self.socket.listen(128)
+        self.server_address = self.socket.getsockname()
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            client, _ = self.socket.accept()
+            upstream = socket.create_connection(self.target_address)
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.pump, args=(client, upstream, True), daemon=True).start()
+            threading.Thread(target=self.pump, args=(upstream, client, False), daemon=True).start()
+
+    def pump(self, source, target, outgoing):
+        try:
+            while True:
+                data = source.recv(1 << 16)
+                if not data:
+                    break
+                self.forward(target, data, outgoing)
+        except OSError:
+            pass
+        finally:
+            target.close()
+
+    def forward(self, target, data, outgoing):
+        with self.lock:
+            if outgoing:
+                self.bytes_sent += len(data)
+            else:
+                self.bytes_received += len(data)
+        target.sendall(data)
+
+    def reset(self):
+        with self.lock:
+            self.bytes_sent = self.bytes_received = 0
+
+
+class ThrottledRelay(CountingRelay):
+    def __init__(self, target_address, bandwidth):
+        self.bandwidth = bandwidth
+        self.link_lock = threading.Lock()
+        super().__init__(target_address)
+
+    def forward(self, target, data, outgoing):
+        if not outgoing:
+            with self.link_lock:
+                time.sleep(len(data) / self.bandwidth)
+        super().forward(target, data, outgoing)
+
+
+def start_echo_server(server):
+    server.register_function(lambda user_id, path: (True, True, path), 'path_check')
+    server.register_function(lambda data: len(data.data), 'put_block')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_calls(url, calls, persistent, method, *params):
+    proxy = connect(url)
+    started = time.perf_counter()
+    for _ in range(calls):
+        if persistent:
+            getattr(proxy, method)(*params)
+        else:
+            with connect(url) as new_proxy:
+                getattr(new_proxy, method)(*params)
+    elapsed = time.perf_counter() - started
+    proxy('close')()
+    return calls / elapsed
+
+
+def benchmark_transport(calls, payload_size):
+    xmlrpc_server = start_echo_server(SimpleXMLRPCServer(('localhost', 0), allow_none=True, logRequests=False))
+    binary_server = start_echo_server(BinaryRPCServer(('localhost', 0)))
+    payload = Binary(os.urandom(payload_size))
+
+    print('{0:8s} {1:11s} {2:13s} {3:>10s} {4:>14s}'.format('Transport', 'Connection', 'Call', 'Calls/s',
+                                                            'Bytes/call'))
+    for name, server in (('xmlrpc', xmlrpc_server), ('binary', binary_server)):
+        relay = CountingRelay(server.server_address)
+        url = '{}://{}:{}'.format(get_server_url(server).split(':')[0], *relay.server_address)
+        for persistent in (False, True):
+            for label, method, params in (('path_check', 'path_check', (1, 'docs/a.txt')),
+                                          ('chunk', 'put_block', (payload, ))):
+                relay.reset()
+                rate = run_calls(url, calls, persistent, method, *params)
+                time.sleep(0.1)
+                wire_bytes = (relay.bytes_sent + relay.bytes_received) / calls
+                print('{0:8s} {1:11s} {2:13s} {3:10.0f} {4:14.0f}'.format(
+                    name, 'persistent' if persistent else 'per-call', label, rate, wire_bytes))
+
+
+def is_running(process):
+    if isinstance(process, multiprocessing.Process):
+        return process.is_alive()
+    return process.poll() is None
+
+
+def wait_until_serving(process, url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and is_running(process):
+        try:
+            with connect(url) as new_proxy:
+                if new_proxy.ping():
+                    return
+        except (OSError, Fault, ProtocolError):
+            time.sleep(0.1)
+    raise RuntimeError('{} did not start serving'.format(url))
+
+
+def get_name_server_url(port):
+    return '{}://localhost:{}'.format('tcp' if transport == 'binary' else 'http', port)
+
+
+def get_file_server_url(port):
+    return '{}://127.0.0.1:{}'.format('tcp' if transport == 'binary' else 'http', port)
+
+
+def start_file_server(work_dir, env, server_id, port, seed=None):
+    user_dir = Path(work_dir) / 'rpc_server_files' / str(server_id) / '1'
+    user_dir.mkdir(parents=True, exist_ok=True)
+    (user_dir / 'seed.txt').write_text(str(server_id))
+    if seed is not None:
+        seed(server_id, user_dir)
+
+    return subprocess.Popen([sys.executable, str(src_dir / 'rpc_server.py'), str(server_id), str(port)],
+                            cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def start_cluster(work_dir, server_count, base_port=8100, seed=None):
+    env = dict(os.environ, HOME=work_dir)
+    processes = [subprocess.Popen([sys.executable, str(src_dir / 'name_server.py'), str(shard), str(replica)],
+                                  cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                 for shard, urls in enumerate(name_server_urls) for replica in range(len(urls))]
+    try:
+        for process, url in zip(processes, [url for urls in name_server_urls for url in urls]):
+            wait_until_serving(process, url)
+        for server_id in range(1, server_count + 1):
+            processes.append(start_file_server(work_dir, env, server_id, base_port + server_id, seed))
+            wait_until_serving(processes[-1], get_file_server_url(base_port + server_id))
+    except RuntimeError:
+        stop_cluster(processes)
+        raise
+    return processes
+
+
+def stop_cluster(processes):
+    proxy_pool.close()
+    for process in reversed(processes):
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def time_calls(calls, function, *params):
+    started = time.perf_counter()
+    for _ in range(calls):
+        function(*params)
+    return (time.perf_counter() - started) / calls * 1000
+
+
+def sequential_change_dir(user_id, cloud_dir_path):
+    for address in rpc_client.proxy.get_server_addresses(user_id):
+        path_valid, path_exists, rel_path_str = rpc_client.call_server(address, 'path_check',
+                                                                       (user_id, cloud_dir_path))
+        if not path_valid:
+            return False, ''
+        elif path_exists:
+            return True, rel_path_str
+    return False, ''
+
+
+def sequential_list(user_id, cloud_dir_path):
+    for address in rpc_client.proxy.get_server_addresses(user_id):
+        rpc_client.call_server(address, 'get_filenames', (user_id, cloud_dir_path))
+
+
+def with_round_trip_time(call_server, rtt):
+    def delayed_call_server(address, method, params):
+        time.sleep(rtt)
+        return call_server(address, method, params)
+    return delayed_call_server
+
+
+def concurrent_list(user_id, cloud_dir_path):
+    rpc_client.listing_cache.invalidate(user_id)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        rpc_client.list_file_names(user_id, cloud_dir_path)
+
+
+def benchmark_fanout(server_counts, calls, rtt):
+    rpc_client.proxy = ShardedProxy(name_server_urls)
+    rpc_client.call_server = with_round_trip_time(rpc_client.call_server, rtt / 1000)
+
+    print('Simulated round trip time: {} ms'.format(rtt))
+    print('{0:>7s} {1:>15s} {2:>15s} {3:>15s} {4:>15s}'.format('Servers', 'cd seq (ms)', 'cd fan-out (ms)',
+                                                                'ls seq (ms)', 'ls fan-out (ms)'))
+    for server_count in server_counts:
+        with tempfile.TemporaryDirectory() as work_dir:
+            def seed(server_id, user_dir):
+                if server_id == server_count:
+                    (user_dir / 'bench').mkdir()
+
+            processes = start_cluster(work_dir, server_count, seed=seed)
+            try:
+                print('{0:7d} {1:15.2f} {2:15.2f} {3:15.2f} {4:15.2f}'.format(
+                    server_count,
+                    time_calls(calls, sequential_change_dir, 1, 'bench'),
+                    time_calls(calls, rpc_client.can_change_dir, 1, 'bench'),
+                    time_calls(calls, sequential_list, 1, ''),
+                    time_calls(calls, concurrent_list, 1, '')))
+            finally:
+                stop_cluster(processes)
+
+
+def metadata_client(client_id, duration, results):
+    operations = 0
+    name_proxy = ReplicaGroup(name_server_urls[0])
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        name_proxy.get_user_credentials('bench')
+        name_proxy.get_server_addresses(1)
+        name_proxy.get_file_hashes(1, 'seed.txt')
+        name_proxy.save_file_info([(1, 1, 'bench/{}'.format(client_id), 'file', 0, '', 0)])
+        name_proxy.remove_file(1, 'bench/{}'.format(client_id))
+        operations += 5
+    results.put(operations)
+
+
+def benchmark_metadata(client_counts, duration):
+    print('{0:>7s} {1:>12s}'.format('Clients', 'Ops/s'))
+    with tempfile.TemporaryDirectory() as work_dir:
+        processes = start_cluster(work_dir, 1)
+        try:
+            ReplicaGroup(name_server_urls[0]).save_user('bench', 'eA==', 'eA==')
+            proxy_pool.close()
+
+            for client_count in client_counts:
+                results = multiprocessing.Queue()
+                clients = [multiprocessing.Process(target=metadata_client, args=(client_id, duration, results))
+                           for client_id in range(client_count)]
+                for client in clients:
+                    client.start()
+                operations = sum(results.get() for _ in clients)
+                for client in clients:
+                    client.join()
+                print('{0:7d} {1:12.0f}'.format(client_count, operations / duration))
+        finally:
+            stop_cluster(processes)
+
+
+def run_shard(shard, shard_count, port, db_path):
+    name_server.name_server_db = db_path
+    name_server.shard_index, name_server.shard_count = shard, shard_count
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        name_server.serve(('localhost', port), [get_name_server_url(port)], 0)
+
+
+def start_shards(work_dir, shard_count, base_port=9100):
+    processes = [multiprocessing.Process(target=run_shard, daemon=True,
+                                         args=(shard, shard_count, base_port + shard,
+                                               os.path.join(work_dir, 'info.{}.db'.format(shard))))
+                 for shard in range(shard_count)]
+    urls = [[get_name_server_url(base_port + shard)] for shard in range(shard_count)]
+    for process in processes:
+        process.start()
+    for process, replica_urls in zip(processes, urls):
+        wait_until_serving(process, replica_urls[0])
+    return processes, urls
+
+
+def stop_shards(processes):
+    proxy_pool.close()
+    for process in processes:
+        process.terminate()
+        process.join()
+
+
+def shard_client(client_id, urls, duration, results):
+    username = 'bench{}'.format(client_id)
+    with connect(urls[get_username_shard(username, len(urls))][0]) as name_proxy:
+        user_id = name_proxy.get_user_credentials(username)[0]
+
+    operations = 0
+    with connect(urls[get_user_shard(user_id, len(urls))][0]) as name_proxy:
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            name_proxy.get_user_credentials(username)
+            name_proxy.get_server_addresses(user_id)
+            name_proxy.get_file_hashes(user_id, 'bench/{}'.format(client_id))
+            name_proxy.save_file_info([(user_id, 1, 'bench/{}'.format(client_id), 'file', 0, '', 0)])
+            name_proxy.remove_file(user_id, 'bench/{}'.format(client_id))
+            operations += 5
+    results.put(operations)
+
+
+def benchmark_shards(shard_counts, client_count, duration):
+    print('{0:>7s} {1:>15s} {2:>12s}'.format('Shards', 'Users/shard', 'Ops/s'))
+    for shard_count in shard_counts:
+        with tempfile.TemporaryDirectory() as work_dir:
+            processes, urls = start_shards(work_dir, shard_count)
+            try:
+                name_proxy = ShardedProxy(urls)
+                for client_id in range(client_count):
+                    name_proxy.save_user('bench{}'.format(client_id), 'eA==', 'eA==')
+                proxy_pool.close()
+                users = [get_username_shard('bench{}'.format(client_id), shard_count)
+                         for client_id in range(client_count)]
+
+                results = multiprocessing.Queue()
+                clients = [multiprocessing.Process(target=shard_client, args=(client_id, urls, duration, results))
+                           for client_id in range(client_count)]
+                for client in clients:
+                    client.start()
+                operations = sum(results.get() for _ in clients)
+                for client in clients:
+                    client.join()
+                print('{0:7d} {1:>15s} {2:12.0f}'.format(
+                    shard_count, '/'.join(str(users.count(shard)) for shard in range(shard_count)),
+                    operations / duration))
+            finally:
+                stop_shards(processes)
+
+
+def run_replica(replica, urls, port, db_path, batching):
+    name_server.name_server_db = db_path
+    name_server.raft_batching = batching
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        name_server.serve(('localhost', port), urls, replica)
+
+
+def start_replicas(work_dir, replica_count, batching, base_port=9200):
+    urls = [get_name_server_url(base_port + replica) for replica in range(replica_count)]
+    processes = [multiprocessing.Process(target=run_replica, daemon=True,
+                                         args=(replica, urls, base_port + replica,
+                                               os.path.join(work_dir, 'info.{}.db'.format(replica)), batching))
+                 for replica in range(replica_count)]
+    for process in processes:
+        process.start()
+    for process, url in zip(processes, urls):
+        wait_until_serving(process, url)
+    ReplicaGroup(urls).get_server_states()
+    proxy_pool.close()
+    return processes, urls
+
+
+def raft_client(client_id, urls, duration, results):
+    operations = 0
+    name_proxy = ReplicaGroup(urls)
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        name_proxy.save_file_info([(1, 1, 'bench/{}'.format(client_id), 'file', 0, '', 0)])
+        name_proxy.remove_file(1, 'bench/{}'.format(client_id))
+        operations += 2
+    results.put(operations)
+
+
+def benchmark_raft(replica_counts, client_count, duration):
+    print('{0:>8s} {1:>9s} {2:>12s} {3:>12s}'.format('Replicas', 'Batching', 'Writes/s', 'Slowdown'))
+    baseline = {}
+    for replica_count in replica_counts:
+        for batching in (False, True):
+            with tempfile.TemporaryDirectory() as work_dir:
+                processes, urls = start_replicas(work_dir, replica_count, batching)
+                try:
+                    results = multiprocessing.Queue()
+                    clients = [multiprocessing.Process(target=raft_client, args=(client_id, urls, duration, results))
+                               for client_id in range(client_count)]
+                    for client in clients:
+                        client.start()
+                    throughput = sum(results.get() for _ in clients) / duration
+                    for client in clients:
+                        client.join()
+                    baseline.setdefault(batching, throughput)
+                    print('{0:8d} {1:>9s} {2:12.0f} {3:11.2f}x'.format(replica_count, 'on' if batching else 'off',
+                                                                      throughput, baseline[batching] / throughput))
+                finally:
+                    stop_shards(processes)
+
+
+def benchmark_stripe(replica_counts, size_mb, bandwidth_mb):
+    data = os.urandom(size_mb * 1024 * 1024)
+    server_count = max(replica_counts)
+
+    def seed(server_id, user_dir):
+        file_dir = user_dir if server_id == 1 else user_dir.parent / '1_backup'
+        file_dir.mkdir(exist_ok=True)
+        (file_dir / 'big.bin').write_bytes(data)
+
+    print('{} MiB file, {} MiB/s per server'.format(size_mb, bandwidth_mb))
+    print('{0:>8s} {1:>10s} {2:>12s}'.format('Replicas', 'Time (s)', 'MiB/s'))
+    with tempfile.TemporaryDirectory() as work_dir:
+        processes = start_cluster(work_dir, server_count, seed=seed)
+        try:
+            addresses = [get_file_server_url(8100 + server_id) for server_id in range(1, server_count + 1)]
+            relays = {address: ThrottledRelay(('127.0.0.1', int(address.rsplit(':', 1)[1])),
+                                              bandwidth_mb * 1024 * 1024) for address in addresses}
+            relay_urls = {address: '{}://{}:{}'.format(address.split(':')[0], *relay.server_address)
+                          for address, relay in relays.items()}
+            pool.connect = lambda address, timeout=None: connect(relay_urls.get(address, address), timeout)
+            rpc_client.content_cache = ContentCache(os.path.join(work_dir, 'cache'), 4 * len(data))
+
+            for replica_count in replica_counts:
+                rpc_client.content_cache.invalidate(1, 'big.bin')
+                started = time.perf_counter()
+                cached_path = rpc_client.download_file(1, 'big.bin', addresses[0], addresses[1:replica_count])
+                elapsed = time.perf_counter() - started
+                if cached_path is None or Path(cached_path).read_bytes() != data:
+                    raise RuntimeError('Striped download with {} replicas failed'.format(replica_count))
+                print('{0:8d} {1:10.2f} {2:12.1f}'.format(replica_count, elapsed, size_mb / elapsed))
+        finally:
+            stop_cluster(processes)
+
+
+legacy_queries = {
+    'listing': '''SELECT FILENAME, LASTMODIFIED FROM FILES WHERE ISBACKUP = 0 AND USERID = ? AND PATH LIKE ?;''',
+    'server_addresses': '''SELECT DISTINCT ADDRESS FROM FILES JOIN SERVERS USING (SERVERID)
+                            WHERE ISBACKUP = 0 AND USERID = ?;''',
+    'backup_servers': '''SELECT ADDRESS FROM FILES JOIN SERVERS USING (SERVERID)
+                          WHERE ISBACKUP = 1 AND SERVERID != ? AND USERID = ? AND PATH = ?''',
+    'file_hashes': '''SELECT ISBACKUP, FILEHASH, ADDRESS FROM FILES JOIN SERVERS USING (SERVERID)
+                       WHERE USERID = ? AND PATH = ? ORDER BY ISBACKUP DESC;''',
+}
+
+
+def generate_file_rows(rows, users, dirs, server_count):
+    files_per_user = rows // users // 2
+    for user_id in range(1, users + 1):
+        for index in range(files_per_user):
+            path = 'dir{}/file{}.txt'.format(index % dirs, index)
+            server_id = (user_id + index) % server_count + 1
+            for is_backup in (0, 1):
+                yield (user_id, (server_id + is_backup) % server_count + 1, path, 'file{}.txt'.format(index),
+                       is_backup, '0' * 64, 1.0)
+
+
+def build_legacy_db(db_path, rows, users, dirs, server_count):
+    connection = sqlite3.connect(db_path)
+    connection.execute('''CREATE TABLE SERVERS (SERVERID INTEGER PRIMARY KEY, ADDRESS TEXT);''')
+    connection.execute('''CREATE TABLE FILES (FILEID INTEGER PRIMARY KEY AUTOINCREMENT, USERID INTEGER,
+                                               SERVERID INTEGER, PATH TEXT, FILENAME TEXT, ISBACKUP INTEGER,
+                                               FILEHASH TEXT, LASTMODIFIED REAL);''')
+    connection.executemany('INSERT INTO SERVERS VALUES (?, ?);',
+                           [(server_id, 'tcp://s{}'.format(server_id)) for server_id in range(1, server_count + 1)])
+    connection.executemany('''INSERT INTO FILES (USERID, SERVERID, PATH, FILENAME, ISBACKUP, FILEHASH, LASTMODIFIED)
+                              VALUES (?, ?, ?, ?, ?, ?, ?)''', generate_file_rows(rows, users, dirs, server_count))
+    connection.commit()
+    return connection
+
+
+def build_current_db(db_path, rows, users, dirs, server_count):
+    name_server.name_server_db = db_path
+    name_server.init_db()
+    for server_id in range(1, server_count + 1):
+        name_server.register_file_server(server_id, 'tcp://s{}'.format(server_id))
+    file_rows = generate_file_rows(rows, users, dirs, server_count)
+    while True:
+        batch = list(itertools.islice(file_rows, 100000))
+        if not batch:
+            break
+        name_server.save_file_info(batch)
+
+
+def legacy_listing(cursor, user_id, dir_paths):
+    for dir_path in dir_paths:
+        cursor.execute(legacy_queries['listing'], (user_id, dir_path + '%'))
+        cursor.fetchall()
+
+
+def legacy_next_server(cursor):
+    cursor.execute('SELECT COUNT(*) FROM SERVERS;')
+    count = cursor.fetchone()[0]
+    cursor.execute('SELECT ADDRESS FROM SERVERS WHERE SERVERID = ?;', (count, ))
+    cursor.fetchone()
+
+
+def legacy_query(cursor, name, *params):
+    cursor.execute(legacy_queries[name], params)
+    cursor.fetchall()
+
+
+def benchmark_schema(rows, users, dirs, server_count, queries):
+    files_per_dir = rows // users // 2 // dirs
+    dir_files = ['dir0/file{}.txt'.format(index * dirs) for index in range(files_per_dir)]
+    print('{} file rows, {} users, {} files per directory'.format(rows, users, files_per_dir))
+    print('{0:18s} {1:>14s} {2:>14s}'.format('Query', 'Before (ms)', 'After (ms)'))
+    with tempfile.TemporaryDirectory() as work_dir:
+        legacy = build_legacy_db(os.path.join(work_dir, 'legacy.db'), rows, users, dirs, server_count).cursor()
+        build_current_db(os.path.join(work_dir, 'current.db'), rows, users, dirs, server_count)
+
+        for label, before, after in (
+                ('listing', (legacy_listing, legacy, 1, dir_files), (name_server.get_dir_infos, 1, 'dir0')),
+                ('server_addresses', (legacy_query, legacy, 'server_addresses', 1),
+                 (name_server.get_server_addresses, 1)),
+                ('backup_servers', (legacy_query, legacy, 'backup_servers', 1, 1, 'dir0/file0.txt'),
+                 (name_server.get_file_backup_servers, 1, 1, 'dir0/file0.txt')),
+                ('file_hashes', (legacy_query, legacy, 'file_hashes', 1, 'dir0/file0.txt'),
+                 (name_server.get_file_hashes, 1, 'dir0/file0.txt')),
+                ('next_server', (legacy_next_server, legacy), (name_server.get_next_server, ))):
+            print('{0:18s} {1:14.3f} {2:14.3f}'.format(label, time_calls(queries, *before),
+                                                       time_calls(queries, *after)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    transport_parser = subparsers.add_parser('transport', help='Compare the XML-RPC and binary transports.')
+    transport_parser.add_argument('--calls', help='Calls per measurement.', type=int, default=2000)
+    transport_parser.add_argument('--payload', help='Chunk payload size in bytes.', type=int, default=64 * 1024)
+
+    fanout_parser = subparsers.add_parser('fanout', help='Compare sequential and concurrent per-server queries.')
+    fanout_parser.add_argument('--servers', help='Cluster sizes to measure.', type=int, nargs='+',
+                               default=[1, 2, 4, 8, 16, 32])
+    fanout_parser.add_argument('--calls', help='Calls per measurement.', type=int, default=50)
+    fanout_parser.add_argument('--rtt', help='Simulated network round trip time in ms.', type=float, default=1.0)
+
+    metadata_parser = subparsers.add_parser('metadata', help='Measure name server ops/s with concurrent clients.')
+    metadata_parser.add_argument('--clients', help='Client process counts to measure.', type=int, nargs='+',
+                                 default=[1, 2, 4, 8, 16])
+    metadata_parser.add_argument('--duration', help='Seconds per measurement.', type=float, default=5)
+
+    schema_parser = subparsers.add_parser('schema', help='Compare name server queries before and after indexing.')
+    schema_parser.add_argument('--rows', help='File rows to generate.', type=int, default=1000000)
+    schema_parser.add_argument('--users', help='Users owning the rows.', type=int, default=100)
+    schema_parser.add_argument('--dirs', help='Directories per user.', type=int, default=50)
+    schema_parser.add_argument('--servers', help='File servers.', type=int, default=8)
+    schema_parser.add_argument('--queries', help='Calls per measurement.', type=int, default=5)
+
+    shards_parser = subparsers.add_parser('shards', help='Measure metadata ops/s as name server shards are added.')
+    shards_parser.add_argument('--shards', help='Shard counts to measure.', type=int, nargs='+', default=[1, 2, 4])
+    shards_parser.add_argument('--clients', help='Client processes per measurement.', type=int, default=16)
+    shards_parser.add_argument('--duration', help='Seconds per measurement.', type=float, default=5)
+
+    raft_parser = subparsers.add_parser('raft', help='Compare replicated name server write throughput.')
+    raft_parser.add_argument('--replicas', help='Replica counts to measure.', type=int, nargs='+', default=[1, 3, 5])
+    raft_parser.add_argument('--clients', help='Client processes per measurement.', type=int, default=16)
+    raft_parser.add_argument('--duration', help='Seconds per measurement.', type=float, default=5)
+
+    stripe_parser = subparsers.add_parser('stripe', help='Measure download throughput striped over replicas.')
+    stripe_parser.add_argument('--replicas', help='Replica counts to measure.', type=int, nargs='+',
+                               default=[1, 2, 4])
+    stripe_parser.add_argument('--size', help='File size in MiB.', type=int, default=64)
+    stripe_parser.add_argument('--bandwidth', help='Simulated bandwidth per server in MiB/s.', type=float,
+                               default=20)
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'transport':
+        benchmark_transport(args.calls, args.payload)
+    elif args.benchmark == 'fanout':
+        import rpc_client
+        benchmark_fanout(args.servers, args.calls, args.rtt)
+    elif args.benchmark == 'metadata':
+        benchmark_metadata(args.clients, args.duration)
+    elif args.benchmark == 'schema':
+        import name_server
+        benchmark_schema(args.rows, args.users, args.dirs, args.servers, args.queries)
+    elif args.benchmark == 'shards':
+        import name_server
+        benchmark_shards(args.shards, args.clients, args.duration)
+    elif args.benchmark == 'raft':
+        import name_server
+        benchmark_raft(args.replicas, args.clients, args.duration)
+    elif args.benchmark == 'stripe':
+        import pool
+        import rpc_client
+        from cache import ContentCache
+        benchmark_stripe(args.replicas, args.size, args.bandwidth)
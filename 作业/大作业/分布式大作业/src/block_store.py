@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import collections
+from pathlib import Path
+from config import chunk_size
+
+block_list_header = b'rpc-blocks 1\n'
+max_query_params = 900
+
+
+class BlockStore(object):
+    def __init__(self, blocks_dir, db_path):
+        self.blocks_dir = Path(blocks_dir)
+        self.temp_dir = self.blocks_dir / 'tmp'
+        self.temp_dir.mkdir(parents=True, exist_ok=True)
+        for temp_path in self.temp_dir.iterdir():
+            temp_path.unlink()
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS BLOCKS
+                                   (HASH TEXT PRIMARY KEY, SIZE INTEGER NOT NULL, REFS INTEGER NOT NULL,
+                                    RELEASED REAL);''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS BLOCKS_RELEASED ON BLOCKS (RELEASED) WHERE REFS = 0;')
+
+    def get_block_path(self, block_hash):
+        return self.blocks_dir / block_hash[:2] / block_hash
+
+    def get_missing(self, block_hashes):
+        block_hashes = list(dict.fromkeys(block_hashes))
+        present = set()
+        with self.lock:
+            for start in range(0, len(block_hashes), max_query_params):
+                batch = block_hashes[start:start + max_query_params]
+                present.update(row[0] for row in self.connection.execute(
+                    'SELECT HASH FROM BLOCKS WHERE HASH IN ({});'.format(', '.join('?' * len(batch))), batch))
+        return [block_hash for block_hash in block_hashes if block_hash not in present]
+
+    def put(self, data):
+        block_hash = hashlib.sha256(data).hexdigest()
+        if not self.get_missing([block_hash]):
+            return block_hash
+
+        with tempfile.NamedTemporaryFile(dir=str(self.temp_dir), delete=False) as handle:
+            handle.write(data)
+            handle.flush()
+            os.fsync(handle.fileno())
+
+        block_path = self.get_block_path(block_hash)
+        with self.lock:
+            block_path.parent.mkdir(exist_ok=True)
+            os.replace(handle.name, str(block_path))
+            self.connection.execute('INSERT OR IGNORE INTO BLOCKS VALUES (?, ?, 0, ?);',
+                                    (block_hash, len(data), time.time()))
+            self.connection.commit()
+        return block_hash
+
+    def read(self, block_hash):
+        with open(str(self.get_block_path(block_hash)), 'rb') as handle:
+            return handle.read()
+
+    def read_range(self, block_list, offset, length):
+        block = self.read(block_list['blocks'][offset // chunk_size])
+        start = offset % chunk_size
+        return block[start:start + length]
+
+    def add_refs(self, block_hashes):
+        with self.lock:
+            if self.get_missing(block_hashes):
+                return False
+            self.connection.executemany('UPDATE BLOCKS SET REFS = REFS + ?, RELEASED = NULL WHERE HASH = ?;',
+                                        [(count, block_hash) for block_hash, count
+                                         in collections.Counter(block_hashes).items()])
+            self.connection.commit()
+        return True
+
+    def release(self, block_hashes):
+        now = time.time()
+        with self.lock:
+            self.connection.executemany('''UPDATE BLOCKS SET REFS = MAX(REFS - ?, 0),
+                                           RELEASED = CASE WHEN REFS <= ? THEN ? ELSE RELEASED END
+                                           WHERE HASH = ?;''',
+                                        [(count, count, now, block_hash) for block_hash, count
+                                         in collections.Counter(block_hashes).items()])
+            self.connection.commit()
+
+    def collect_garbage(self, grace):
+        with self.lock:
+            block_hashes = [row[0] for row in self.connection.execute(
+                'SELECT HASH FROM BLOCKS WHERE REFS = 0 AND RELEASED < ?;', (time.time() - grace, ))]
+            for block_hash in block_hashes:
+                try:
+                    os.remove(str(self.get_block_path(block_hash)))
+                except FileNotFoundError:
+                    pass
+            self.connection.executemany('DELETE FROM BLOCKS WHERE HASH = ?;',
+                                        [(block_hash, ) for block_hash in block_hashes])
+            self.connection.commit()
+        return len(block_hashes)
+
+    def verify(self, block_list):
+        hash_obj = hashlib.sha256()
+        size = 0
+        for block_hash in block_list['blocks']:
+            block = self.read(block_hash)
+            hash_obj.update(block)
+            size += len(block)
+        return size == block_list['size'] and hash_obj.hexdigest() == block_list['hash']
+
+    def read_block_list(self, file_path):
+        try:
+            with open(file_path, 'rb') as handle:
+                if handle.read(len(block_list_header)) != block_list_header:
+                    return None
+                return json.loads(handle.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return None
+
+    def write_block_list(self, file_path, block_list):
+        with tempfile.NamedTemporaryFile(dir=str(self.temp_dir), delete=False) as handle:
+            handle.write(block_list_header + json.dumps(block_list).encode('utf-8'))
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(handle.name, file_path)
+
+    def ingest(self, file_path):
+        stat = os.stat(file_path)
+        hash_obj = hashlib.sha256()
+        block_hashes = []
+        with open(file_path, 'rb') as handle:
+            while True:
+                block = handle.read(chunk_size)
+                if not block:
+                    break
+                hash_obj.update(block)
+                block_hashes.append(self.put(block))
+
+        block_list = {'size': stat.st_size, 'hash': hash_obj.hexdigest(), 'blocks': block_hashes}
+        self.add_refs(block_hashes)
+        self.write_block_list(file_path, block_list)
+        os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        return block_list
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,120 @@
+import os
+import time
+import hashlib
+import threading
+import collections
+from pathlib import Path
+
+
+class ContentCache(object):
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = None
+        self.prefixes = {}
+        self.total_size = 0
+
+    def load(self):
+        if self.entries is not None:
+            return
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for entry_path in self.cache_dir.iterdir():
+            if entry_path.suffix == '.part':
+                continue
+            try:
+                stat = entry_path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, entry_path.name, stat.st_size))
+
+        self.entries = collections.OrderedDict()
+        for _, entry_name, size in sorted(entries):
+            self.add_entry(entry_name, size)
+
+    def add_entry(self, entry_name, size):
+        self.entries[entry_name] = size
+        self.prefixes.setdefault(entry_name.split('-', 1)[0], set()).add(entry_name)
+        self.total_size += size
+
+    def remove_entry(self, entry_name):
+        self.total_size -= self.entries.pop(entry_name)
+        prefix = entry_name.split('-', 1)[0]
+        self.prefixes[prefix].discard(entry_name)
+        if not self.prefixes[prefix]:
+            del self.prefixes[prefix]
+        try:
+            (self.cache_dir / entry_name).unlink()
+        except OSError:
+            pass
+
+    def get_prefix(self, user_id, cloud_file_path):
+        key = '{}:{}'.format(user_id, os.path.normpath(cloud_file_path))
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get_entry_path(self, user_id, cloud_file_path, file_hash):
+        return self.cache_dir / '{}-{}'.format(self.get_prefix(user_id, cloud_file_path), file_hash)
+
+    def get_part_path(self, user_id, cloud_file_path, file_hash):
+        with self.lock:
+            self.load()
+        return str(self.get_entry_path(user_id, cloud_file_path, file_hash)) + '.part'
+
+    def get(self, user_id, cloud_file_path, file_hash):
+        entry_path = self.get_entry_path(user_id, cloud_file_path, file_hash)
+        with self.lock:
+            self.load()
+            if entry_path.name not in self.entries:
+                return None
+            try:
+                os.utime(str(entry_path))
+            except OSError:
+                self.remove_entry(entry_path.name)
+                return None
+            self.entries.move_to_end(entry_path.name)
+        return str(entry_path)
+
+    def put(self, user_id, cloud_file_path, file_hash, file_path):
+        self.invalidate(user_id, cloud_file_path)
+        entry_path = self.get_entry_path(user_id, cloud_file_path, file_hash)
+        with self.lock:
+            os.replace(file_path, str(entry_path))
+            self.add_entry(entry_path.name, os.stat(str(entry_path)).st_size)
+            self.evict()
+        return str(entry_path)
+
+    def invalidate(self, user_id, cloud_file_path):
+        prefix = self.get_prefix(user_id, cloud_file_path)
+        with self.lock:
+            self.load()
+            for entry_name in list(self.prefixes.get(prefix, ())):
+                self.remove_entry(entry_name)
+
+    def evict(self):
+        while self.total_size > self.max_size and self.entries:
+            self.remove_entry(next(iter(self.entries)))
+
+
+class ListingCache(object):
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, user_id, cloud_dir_path):
+        with self.lock:
+            entry = self.entries.get((user_id, os.path.normpath(cloud_dir_path)))
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            return None
+        return entry[1]
+
+    def put(self, user_id, cloud_dir_path, listing):
+        with self.lock:
+            self.entries[(user_id, os.path.normpath(cloud_dir_path))] = (time.monotonic(), listing)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == user_id]:
+                del self.entries[key]
@@ -1,2 +1,70 @@
-name_server_info = ('localhost', 9999)
-name_server_url = 'http://{}:{}'.format(name_server_info[0], name_server_info[1])
+transport = 'binary'
+name_server_shards = [[(('localhost', 9999), 'info.db')]]
+name_server_urls = [['{}://{}:{}'.format('tcp' if transport == 'binary' else 'http', *name_server_info)
+                     for name_server_info, _ in replicas] for replicas in name_server_shards]
+name_server_timeout = 5
+name_server_failover_timeout = 10
+name_server_retry_backoff = 0.05
+raft_election_timeout = 1
+raft_heartbeat_interval = 0.1
+raft_lease_duration = 0.8
+raft_batching = True
+raft_batch_size = 256
+raft_request_history = 100000
+chunk_size = 1024 * 1024
+transfer_retries = 3
+pool_max_idle = 8
+pool_idle_timeout = 60
+pool_health_check_interval = 10
+file_server_timeout = 60
+file_copy_timeout = 3600
+discard_timeout = 5
+fan_out_workers = 32
+fan_out_timeout = 10
+file_server_read_workers = 8
+file_server_read_queue = 32
+file_server_upload_workers = 4
+file_server_upload_queue = 8
+busy_retries = 5
+busy_backoff = 0.1
+content_cache_dir = '~/.rpc_client_cache'
+content_cache_size = 256 * 1024 * 1024
+listing_cache_ttl = 5
+registration_batch_size = 1000
+sync_replication = False
+replication_workers = 2
+replication_retries = 5
+replication_backoff = 1
+replication_factor = 2
+heartbeat_interval = 1
+free_space_bucket = 1024
+min_free_space = 1024
+latency_ewma_alpha = 0.3
+hedge_percentile = 95
+hedge_min_samples = 20
+hedge_delay = 0.05
+failure_cooldown = 10
+stripe_min_size = 8 * chunk_size
+stripe_workers = 2
+block_gc_interval = 600
+block_gc_grace = 3600
+delta_sync = True
+delta_block_size = 32 * 1024
+delta_search_blocks = 16
+delta_batch_ops = 1024
+delta_session_timeout = 300
+path_lock_stripes = 64
+encryption_chunk_size = 64 * 1024
+encryption_workers = 4
+bulk_transfer_workers = 8
+bulk_batch_size = 64
+failure_detector_window = 100
+failure_detector_min_std = 0.5
+failure_detector_pause = 1
+phi_suspect_threshold = 5
+phi_dead_threshold = 10
+repair_interval = 5
+repair_delay = 30
+repair_workers = 2
+repair_bandwidth = 32 * 1024 * 1024
+ring_virtual_nodes = 128
@@ -0,0 +1,82 @@
+import zlib
+import struct
+import hashlib
+from config import chunk_size, delta_block_size, delta_search_blocks
+
+adler_modulus = 65521
+signature_format = struct.Struct('>I8s')
+
+
+def get_strong_hash(block):
+    return hashlib.sha256(block).digest()[:8]
+
+
+def make_signatures(blocks):
+    signatures = bytearray()
+    for block in blocks:
+        for offset in range(0, len(block), delta_block_size):
+            piece = block[offset:offset + delta_block_size]
+            signatures += signature_format.pack(zlib.adler32(piece), get_strong_hash(piece))
+    return bytes(signatures)
+
+
+def parse_signatures(signatures):
+    blocks = {}
+    for index, (weak, strong) in enumerate(signature_format.iter_unpack(signatures)):
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+    return blocks
+
+
+def match_block(blocks, weak, data, offset):
+    candidates = blocks.get(weak)
+    if candidates is None:
+        return None
+    return candidates.get(get_strong_hash(data[offset:offset + delta_block_size]))
+
+
+def roll(blocks, data, offset):
+    end = offset + delta_block_size
+    weak = zlib.adler32(data[offset:end])
+    a, b = weak & 0xffff, weak >> 16
+    for _ in range(min(delta_block_size, len(data) - end)):
+        out_byte, in_byte = data[offset], data[end]
+        a = (a - out_byte + in_byte) % adler_modulus
+        b = (b - delta_block_size * out_byte + a - 1) % adler_modulus
+        offset += 1
+        end += 1
+        index = match_block(blocks, (b << 16) | a, data, offset)
+        if index is not None:
+            return offset, index
+    return None
+
+
+def generate_delta(data, signatures):
+    blocks = parse_signatures(signatures)
+    offset = literal_start = 0
+    budget = delta_search_blocks
+    while offset + delta_block_size <= len(data):
+        if offset - literal_start >= chunk_size:
+            yield data[literal_start:offset]
+            literal_start = offset
+
+        index = match_block(blocks, zlib.adler32(data[offset:offset + delta_block_size]), data, offset)
+        if index is None and budget > 0:
+            match = roll(blocks, data, offset)
+            if match is None:
+                budget -= 1
+                offset += delta_block_size
+                continue
+            offset, index = match
+        if index is None:
+            offset += delta_block_size
+            continue
+
+        if literal_start < offset:
+            yield data[literal_start:offset]
+        yield index
+        offset += delta_block_size
+        literal_start = offset
+        budget = delta_search_blocks
+
+    if literal_start < len(data):
+        yield data[literal_start:]
@@ -0,0 +1,159 @@
+import os
+import hmac
+import base64
+import struct
+import hashlib
+import itertools
+import collections
+import concurrent.futures
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from config import encryption_chunk_size, encryption_workers
+
+stream_magic = b'RPCS'
+stream_version = 1
+header_format = struct.Struct('>4sBI16s')
+chunk_aad_format = struct.Struct('>QB')
+nonce_size = 12
+tag_size = 16
+
+
+def derive_key(password, salt):
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=bytes(salt, 'utf-8'),
+        iterations=100000,
+        backend=default_backend()
+    )
+    pass_as_bytes = bytes(password, 'utf-8')
+    return base64.urlsafe_b64encode(kdf.derive(pass_as_bytes))
+
+
+def expand_key(key, salt, info):
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info, backend=default_backend()).derive(key)
+
+
+def split_chunks(chunks, size):
+    buffer = bytearray()
+    for data in chunks:
+        buffer += data
+        while len(buffer) > size:
+            yield bytes(buffer[:size]), False
+            del buffer[:size]
+    yield bytes(buffer), True
+
+
+def read_chunks(file_path, size=encryption_chunk_size):
+    with open(file_path, 'rb') as handle:
+        while True:
+            data = handle.read(size)
+            if not data:
+                break
+            yield data
+
+
+class KeyManager(object):
+    def __init__(self, password, salt):
+        key = derive_key(password, salt)
+        self.fernet = Fernet(key)
+        self.stream_key = expand_key(base64.urlsafe_b64decode(key), None, b'rpc stream key')
+        self.nonce_key = expand_key(base64.urlsafe_b64decode(key), None, b'rpc nonce key')
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=encryption_workers)
+
+    def get_path_salt(self, cloud_file_path):
+        return hmac.new(self.nonce_key, cloud_file_path.encode('utf-8'), hashlib.sha256).digest()[:16]
+
+    def seal(self, cipher, header, index, chunk, final):
+        aad = header + chunk_aad_format.pack(index, final)
+        nonce = hmac.new(self.nonce_key, aad + chunk, hashlib.sha256).digest()[:nonce_size]
+        return nonce + cipher.encrypt(nonce, chunk, aad)
+
+    def unseal(self, cipher, header, index, sealed, final):
+        aad = header + chunk_aad_format.pack(index, final)
+        return cipher.decrypt(sealed[:nonce_size], sealed[nonce_size:], aad)
+
+    def run_ordered(self, function, cipher, header, pieces, parallel=True):
+        if not parallel:
+            for index, (piece, final) in enumerate(pieces):
+                yield function(cipher, header, index, piece, final)
+            return
+
+        pending = collections.deque()
+        for index, (piece, final) in enumerate(pieces):
+            pending.append(self.executor.submit(function, cipher, header, index, piece, final))
+            if len(pending) >= encryption_workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def encrypt_stream(self, chunks, salt=None, parallel=True):
+        salt = os.urandom(16) if salt is None else salt
+        header = header_format.pack(stream_magic, stream_version, encryption_chunk_size, salt)
+        yield header
+        yield from self.run_ordered(self.seal, AESGCM(expand_key(self.stream_key, salt, b'rpc file key')), header,
+                                    split_chunks(chunks, encryption_chunk_size), parallel)
+
+    def decrypt_stream(self, chunks, parallel=True):
+        chunks = iter(chunks)
+        buffer = bytearray()
+        for data in chunks:
+            buffer += data
+            if len(buffer) >= header_format.size:
+                break
+        if len(buffer) < header_format.size:
+            raise ValueError('Truncated encrypted file.')
+
+        header = bytes(buffer[:header_format.size])
+        magic, version, chunk_size, salt = header_format.unpack(header)
+        if magic != stream_magic or version != stream_version:
+            raise ValueError('Unsupported encryption format.')
+
+        yield from self.run_ordered(self.unseal, AESGCM(expand_key(self.stream_key, salt, b'rpc file key')), header,
+                                    split_chunks(itertools.chain([bytes(buffer[header_format.size:])], chunks),
+                                                 nonce_size + chunk_size + tag_size), parallel)
+
+    def encrypt(self, data, salt=None):
+        return b''.join(self.encrypt_stream([data], salt))
+
+    def decrypt(self, data):
+        if not data.startswith(stream_magic):
+            return self.fernet.decrypt(data)
+        return b''.join(self.decrypt_stream([data]))
+
+    def encrypt_file(self, source_path, target_path, salt=None, parallel=True):
+        with open(target_path, 'wb') as handle:
+            for data in self.encrypt_stream(read_chunks(source_path), salt, parallel):
+                handle.write(data)
+
+    def decrypt_file(self, source_path, target_path, parallel=True):
+        with open(source_path, 'rb') as handle:
+            legacy = not handle.read(len(stream_magic)).startswith(stream_magic)
+
+        with open(target_path, 'wb') as handle:
+            if legacy:
+                with open(source_path, 'rb') as source:
+                    handle.write(self.fernet.decrypt(source.read()))
+            else:
+                for data in self.decrypt_stream(read_chunks(source_path), parallel):
+                    handle.write(data)
+
+    def run_files(self, function, files):
+        def run(params):
+            try:
+                function(*params, parallel=False)
+            except (IOError, ValueError, InvalidTag, InvalidToken):
+                return False
+            return True
+        return list(self.executor.map(run, files))
+
+    def encrypt_files(self, files):
+        return self.run_files(self.encrypt_file, files)
+
+    def decrypt_files(self, pairs):
+        return self.run_files(self.decrypt_file, pairs)
@@ -0,0 +1,54 @@
+import sqlite3
+import threading
+
+
+class Manifest(object):
+    def __init__(self, db_path):
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS FILES
+                                   (OSPATH TEXT PRIMARY KEY, SIZE INTEGER NOT NULL, MTIME_NS INTEGER NOT NULL,
+                                    USERID INTEGER NOT NULL, PATH TEXT NOT NULL, FILENAME TEXT NOT NULL,
+                                    ISBACKUP INTEGER NOT NULL, FILEHASH TEXT NOT NULL, LASTMODIFIED REAL NOT NULL);''')
+
+    def get_stats(self):
+        return {os_path: (size, mtime_ns) for os_path, size, mtime_ns
+                in self.connection.execute('SELECT OSPATH, SIZE, MTIME_NS FROM FILES;')}
+
+    def get_removal_keys(self, os_paths):
+        keys = []
+        for os_path in os_paths:
+            row = self.connection.execute('SELECT USERID, PATH, ISBACKUP FROM FILES WHERE OSPATH = ?;',
+                                          (os_path, )).fetchone()
+            if row is not None:
+                keys.append(row)
+        return keys
+
+    def get_file_infos(self, server_id, batch_size):
+        cursor = self.connection.execute('''SELECT USERID, PATH, FILENAME, ISBACKUP, FILEHASH, LASTMODIFIED
+                                            FROM FILES ORDER BY OSPATH;''')
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [(user_id, server_id, path, filename, is_backup, file_hash, last_modified)
+                   for user_id, path, filename, is_backup, file_hash, last_modified in rows]
+
+    def count(self):
+        return self.connection.execute('SELECT COUNT(*) FROM FILES;').fetchone()[0]
+
+    def update(self, entries, removed_os_paths):
+        with self.lock:
+            self.connection.executemany('DELETE FROM FILES WHERE OSPATH = ?;',
+                                        [(os_path, ) for os_path in removed_os_paths])
+            self.connection.executemany('''INSERT OR REPLACE INTO FILES
+                                           (OSPATH, SIZE, MTIME_NS, USERID, PATH, FILENAME, ISBACKUP, FILEHASH,
+                                            LASTMODIFIED)
+                                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                                        [(os_path, size, mtime_ns, file_info[0], file_info[2], file_info[3],
+                                          file_info[4], file_info[5], file_info[6])
+                                         for os_path, size, mtime_ns, file_info in entries])
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,76 @@
+import math
+import time
+import threading
+import collections
+from config import heartbeat_interval, failure_detector_window, failure_detector_min_std, failure_detector_pause, \
+    phi_suspect_threshold, phi_dead_threshold
+
+ALIVE = 'alive'
+SUSPECT = 'suspect'
+DEAD = 'dead'
+
+
+class FailureDetector(object):
+    def __init__(self, expected_interval, window, min_std, acceptable_pause, suspect_threshold, dead_threshold):
+        self.expected_interval = expected_interval
+        self.window = window
+        self.min_std = min_std
+        self.acceptable_pause = acceptable_pause
+        self.suspect_threshold = suspect_threshold
+        self.dead_threshold = dead_threshold
+        self.intervals = {}
+        self.last_heartbeat = {}
+        self.lock = threading.Lock()
+
+    def heartbeat(self, server_id):
+        now = time.monotonic()
+        with self.lock:
+            intervals = self.intervals.setdefault(server_id, collections.deque([self.expected_interval],
+                                                                               maxlen=self.window))
+            last_heartbeat = self.last_heartbeat.get(server_id)
+            if last_heartbeat is not None:
+                intervals.append(now - last_heartbeat)
+            self.last_heartbeat[server_id] = now
+
+    def remove(self, server_id):
+        with self.lock:
+            self.intervals.pop(server_id, None)
+            self.last_heartbeat.pop(server_id, None)
+
+    def get_phi(self, server_id):
+        with self.lock:
+            last_heartbeat = self.last_heartbeat.get(server_id)
+            if last_heartbeat is None:
+                return float('inf')
+            intervals = list(self.intervals[server_id])
+
+        mean = sum(intervals) / len(intervals)
+        std = max(math.sqrt(sum((interval - mean) ** 2 for interval in intervals) / len(intervals)), self.min_std)
+        y = min(max((time.monotonic() - last_heartbeat - mean - self.acceptable_pause) / std, -10), 10)
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if y > 0:
+            return -math.log10(e / (1 + e))
+        return -math.log10(1 - 1 / (1 + e))
+
+    def get_silence(self, server_id):
+        with self.lock:
+            last_heartbeat = self.last_heartbeat.get(server_id)
+        return float('inf') if last_heartbeat is None else time.monotonic() - last_heartbeat
+
+    def get_state(self, server_id):
+        phi = self.get_phi(server_id)
+        if phi >= self.dead_threshold:
+            return DEAD
+        if phi >= self.suspect_threshold:
+            return SUSPECT
+        return ALIVE
+
+    def is_alive(self, server_id):
+        return self.get_state(server_id) == ALIVE
+
+    def is_dead(self, server_id):
+        return self.get_state(server_id) == DEAD
+
+
+failure_detector = FailureDetector(heartbeat_interval, failure_detector_window, failure_detector_min_std,
+                                   failure_detector_pause, phi_suspect_threshold, phi_dead_threshold)
@@ -1,60 +1,228 @@
+import os
+import json
+import time
+import queue
 import sqlite3
-from xmlrpc.server import SimpleXMLRPCServer
+import argparse
+import itertools
+import threading
+from xmlrpc.client import Fault, ProtocolError
+from transport import make_server
+from membership import failure_detector, ALIVE, SUSPECT, DEAD
+from ring import HashRing
+from raft import RaftNode
+from pool import proxy_pool
 import base64
-from config import name_server_info
+from config import name_server_shards, name_server_urls, replication_factor, free_space_bucket, repair_interval, \
+    repair_delay, repair_workers, repair_bandwidth, ring_virtual_nodes, raft_election_timeout, \
+    raft_heartbeat_interval, raft_lease_duration, raft_batching, raft_batch_size, file_copy_timeout, min_free_space, \
+    raft_request_history
+
+schema_version = 3
+max_query_params = 900
+name_server_db = name_server_shards[0][0][1]
+shard_index = 0
+shard_count = 1
+raft_node = None
+local = threading.local()
+write_lock = threading.Lock()
+server_counter = itertools.count(1)
+file_servers = {}
+placement_ring = HashRing(ring_virtual_nodes)
+balanced_version = None
+membership_version = 0
+conflicting_files = set()
+server_stats = {}
+unregistered_at = {}
+repair_queue = queue.PriorityQueue()
+repair_counter = itertools.count()
+repair_lock = threading.Lock()
+repair_tasks = set()
+moving_files = set()
+repair_stats = {'pending': 0, 'active': 0, 'repaired': 0, 'degraded': 0, 'failed': 0, 'unrecoverable': 0,
+                'misplaced': 0, 'moved': 0, 'copied_bytes': 0, 'degraded_since': 0, 'last_time_to_redundancy': 0}
+
+
+def get_connection():
+    if not hasattr(local, 'connection'):
+        local.connection = sqlite3.connect(name_server_db, timeout=30)
+        local.connection.execute('PRAGMA journal_mode = WAL;')
+        local.connection.execute('PRAGMA synchronous = NORMAL;')
+    return local.connection
+
+
+class ApplyConnection(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.connection.execute('SAVEPOINT APPLY;')
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.connection.execute('ROLLBACK TO SAVEPOINT APPLY;')
+
+    def release(self):
+        self.connection.execute('RELEASE SAVEPOINT APPLY;')
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
 
 
 def init_user_table():
-    cursor.execute(
+    cursor = get_connection().cursor()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS USERS
+                      (USERID INTEGER PRIMARY KEY AUTOINCREMENT, USERNAME TEXT UNIQUE NOT NULL,
+                       PASSWORD TEXT NOT NULL, SALT TEXT NOT NULL);'''
     )
 
 
 def init_server_table():
-    cursor.execute('DROP TABLE IF EXISTS SERVERS;')
-    connection.commit()
-    cursor.execute(
+    cursor = get_connection().cursor()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS SERVERS
+                      (SERVERID INTEGER PRIMARY KEY, ADDRESS TEXT NOT NULL);'''
     )
+    file_servers.clear()
+    file_servers.update(cursor.execute('SELECT SERVERID, ADDRESS FROM SERVERS;').fetchall())
+    for server_id in file_servers:
+        placement_ring.add(server_id)
+        failure_detector.heartbeat(server_id)
 
 
 def init_file_table():
-    cursor.execute('DROP TABLE IF EXISTS FILES;')
-    connection.commit()
-    cursor.execute(
+    cursor = get_connection().cursor()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS FILES
+                      (FILEID INTEGER PRIMARY KEY AUTOINCREMENT, USERID INTEGER NOT NULL, SERVERID INTEGER NOT NULL,
+                       PATH TEXT NOT NULL, PARENT TEXT NOT NULL, FILENAME TEXT NOT NULL, ISBACKUP INTEGER NOT NULL,
+                       FILEHASH TEXT, LASTMODIFIED REAL, REPLICATION TEXT NOT NULL DEFAULT 'replicated');'''
+    )
+    cursor.execute('CREATE INDEX IF NOT EXISTS FILES_USER_PATH ON FILES (USERID, PATH);')
+    cursor.execute('CREATE INDEX IF NOT EXISTS FILES_USER_PARENT ON FILES (USERID, PARENT, ISBACKUP);')
+    cursor.execute('CREATE INDEX IF NOT EXISTS FILES_USER_BACKUP ON FILES (USERID, ISBACKUP, SERVERID);')
+    cursor.execute('CREATE INDEX IF NOT EXISTS FILES_SERVER ON FILES (SERVERID);')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS FILES_UNREPLICATED ON FILES (USERID, PATH)
+                      WHERE ISBACKUP = 0 AND REPLICATION != 'replicated';''')
+
+
+def init_tombstone_table():
+    cursor = get_connection().cursor()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS TOMBSTONES
+                      (USERID INTEGER NOT NULL, PATH TEXT NOT NULL, SERVERID INTEGER NOT NULL,
+                       ISBACKUP INTEGER NOT NULL, FILEHASH TEXT NOT NULL,
+                       PRIMARY KEY (USERID, PATH, SERVERID, ISBACKUP));'''
+    )
+
+
+def init_request_table():
+    cursor = get_connection().cursor()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS REQUESTS
+                      (REQUESTID TEXT PRIMARY KEY, RESULT TEXT NOT NULL);'''
     )
 
 
+def migrate_db():
+    connection = get_connection()
+    cursor = connection.cursor()
+    version = cursor.execute('PRAGMA user_version;').fetchone()[0]
+    if version < 1:
+        cursor.execute('DROP TABLE IF EXISTS SERVERS;')
+        cursor.execute('DROP TABLE IF EXISTS FILES;')
+    elif version < 3:
+        cursor.execute("ALTER TABLE FILES ADD COLUMN REPLICATION TEXT NOT NULL DEFAULT 'replicated';")
+    connection.commit()
+
+
 def init_db():
+    migrate_db()
     init_user_table()
     init_server_table()
     init_file_table()
-    connection.commit()
+    init_request_table()
+    init_tombstone_table()
+    get_connection().execute('PRAGMA user_version = {};'.format(schema_version))
+    get_connection().commit()
 
 
-def get_next_server():
-    global server_counter
+def get_parent(cloud_file_rel_path):
+    parent = os.path.dirname(os.path.normpath(cloud_file_rel_path)) if cloud_file_rel_path else ''
+    return '' if parent == '.' else parent
 
-    try:
-        cursor.execute('SELECT COUNT(*) FROM SERVERS;')
-        result = cursor.fetchone()
-        server_counter = (server_counter + 1) % result[0]
-        cursor.execute('SELECT ADDRESS FROM SERVERS WHERE SERVERID = ?;', (server_counter + 1, ))
-        address = cursor.fetchone()
-        return address[0]
-    except sqlite3.Error:
+
+def normalize_path(cloud_rel_path):
+    path = os.path.normpath(cloud_rel_path) if cloud_rel_path else ''
+    return '' if path == '.' else path
+
+
+def batched(items):
+    for start in range(0, len(items), max_query_params):
+        yield items[start:start + max_query_params]
+
+
+def get_placement_key(user_id, cloud_file_rel_path):
+    return '{}:{}'.format(user_id, normalize_path(cloud_file_rel_path))
+
+
+def get_ring_servers(user_id, cloud_file_rel_path, excluded_ids=()):
+    return placement_ring.get_servers(get_placement_key(user_id, cloud_file_rel_path), replication_factor,
+                                      lambda server_id: server_id in file_servers and server_id not in excluded_ids)
+
+
+def place_replicas(user_id, cloud_file_rel_path, count, excluded_ids=()):
+    return placement_ring.get_servers(get_placement_key(user_id, cloud_file_rel_path), count,
+                                      lambda server_id: server_id in file_servers and server_id not in excluded_ids
+                                      and failure_detector.is_alive(server_id)
+                                      and server_stats.get(server_id, (min_free_space, 0, 0, 0))[0] >= min_free_space)
+
+
+def get_next_server():
+    candidates = sorted(server_id for server_id in file_servers if failure_detector.is_alive(server_id))
+    if not candidates:
         return ''
 
+    offset = next(server_counter)
+
+    def placement_key(index):
+        free_space, load, _, _ = server_stats.get(candidates[index], (0, 0, 0, 0))
+        return load, -(free_space // free_space_bucket), (index - offset) % len(candidates)
+
+    return file_servers.get(candidates[min(range(len(candidates)), key=placement_key)], '')
+
+
+def heartbeat(server_id, free_space, load, read_rate=0, write_rate=0):
+    if server_id not in file_servers:
+        return False
+    server_stats[server_id] = (free_space, load, read_rate, write_rate)
+    failure_detector.heartbeat(server_id)
+    return True
+
+
+def get_server_states():
+    return [[server_id, address, failure_detector.get_state(server_id), min(failure_detector.get_phi(server_id), 99)]
+            + list(server_stats.get(server_id, (0, 0, 0, 0))) for server_id, address in sorted(file_servers.items())]
+
+
+def get_live_addresses(rows):
+    return [address for server_id, address in rows if not failure_detector.is_dead(server_id)]
+
 
 def save_user(username, hash_password, salt):
+    connection = get_connection()
+    cursor = connection.cursor()
     try:
-        cursor.execute('INSERT INTO USERS (USERNAME, PASSWORD, SALT) VALUES (?, ?, ?);',
-                       (username, str(base64.b64decode(hash_password), 'utf-8'), str(base64.b64decode(salt), 'utf-8')))
-        connection.commit()
+        with write_lock:
+            cursor.execute('''INSERT INTO USERS (USERID, USERNAME, PASSWORD, SALT)
+                              VALUES ((SELECT COALESCE(MAX(USERID) + ?, ?) FROM USERS), ?, ?, ?);''',
+                           (shard_count, shard_index + 1, username, str(base64.b64decode(hash_password), 'utf-8'),
+                            str(base64.b64decode(salt), 'utf-8')))
+            connection.commit()
         return True
     except sqlite3.Error:
+        connection.rollback()
         return False
 
 
 def get_user_credentials(username):
+    cursor = get_connection().cursor()
     try:
         cursor.execute('SELECT USERID, PASSWORD, SALT FROM USERS WHERE USERNAME = ?;', (username, ))
         results = cursor.fetchone()
@@ -64,102 +232,669 @@ def get_user_credentials(username):
 
 
 def get_server_addresses(user_id):
+    cursor = get_connection().cursor()
     try:
-        cursor.execute('''SELECT DISTINCT ADDRESS FROM FILES JOIN SERVERS USING (SERVERID) 
-                            WHERE ISBACKUP = 0 AND USERID = ?;''', (user_id, ))
-        results = cursor.fetchall()
-
-        return [address for (address, ) in results]
+        cursor.execute('''SELECT SERVERID, ADDRESS FROM SERVERS WHERE EXISTS
+                            (SELECT 1 FROM FILES INDEXED BY FILES_USER_BACKUP
+                             WHERE USERID = ? AND ISBACKUP = 0 AND SERVERID = SERVERS.SERVERID);''',
+                       (user_id, ))
+        return get_live_addresses(cursor.fetchall())
     except sqlite3.Error:
         return []
 
 
 def register_file_server(server_id, address):
+    global membership_version
+    connection = get_connection()
+    cursor = connection.cursor()
     try:
-        cursor.execute('INSERT INTO SERVERS (SERVERID, ADDRESS) VALUES (?, ?);', (server_id, address))
-        connection.commit()
+        with write_lock:
+            cursor.execute('INSERT OR REPLACE INTO SERVERS (SERVERID, ADDRESS) VALUES (?, ?);', (server_id, address))
+            connection.commit()
+            file_servers[server_id] = address
+            placement_ring.add(server_id)
+            unregistered_at.pop(server_id, None)
+            failure_detector.remove(server_id)
+            failure_detector.heartbeat(server_id)
+            membership_version += 1
         return True
     except sqlite3.Error:
+        connection.rollback()
         return False
 
 
 def unregister_file_server(server_id):
-    cursor.execute('DELETE FROM SERVERS WHERE SERVERID = ?;', (server_id, ))
-    cursor.execute('DELETE FROM FILES WHERE SERVERID = ?;', (server_id, ))
-    connection.commit()
+    connection = get_connection()
+    cursor = connection.cursor()
+    with write_lock:
+        cursor.execute('DELETE FROM SERVERS WHERE SERVERID = ?;', (server_id, ))
+        connection.commit()
+        file_servers.pop(server_id, None)
+        server_stats.pop(server_id, None)
+        placement_ring.remove(server_id)
+        unregistered_at[server_id] = time.monotonic()
+        failure_detector.remove(server_id)
+
 
+def insert_file_infos(cursor, file_list, replication='replicated'):
+    cursor.executemany('''INSERT INTO FILES
+                          (USERID, SERVERID, PATH, FILENAME, ISBACKUP, FILEHASH, LASTMODIFIED, PARENT, REPLICATION)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                       [tuple(file_info) + (get_parent(file_info[2]), replication) for file_info in file_list])
 
-def save_file_info(file_list):
+
+def save_file_info(file_list, replication='replicated'):
+    connection = get_connection()
+    cursor = connection.cursor()
     try:
-        cursor.executemany('''INSERT INTO FILES (USERID, SERVERID, PATH, FILENAME, ISBACKUP, FILEHASH, LASTMODIFIED) 
-                              VALUES (?, ?, ?, ?, ?, ?, ?)''', file_list)
-        connection.commit()
+        with write_lock:
+            insert_file_infos(cursor, file_list, replication)
+            connection.commit()
         return True
     except sqlite3.Error:
+        connection.rollback()
         return False
 
 
-def get_file_infos(user_id, cloud_dir_paths):
+def bury_file_info(cursor, file_info):
+    cursor.execute('SELECT 1 FROM TOMBSTONES WHERE USERID = ? AND PATH = ? AND FILEHASH = ?;',
+                   (file_info[0], file_info[2], file_info[5]))
+    if cursor.fetchone() is None:
+        return False
+    cursor.execute('''INSERT OR REPLACE INTO TOMBSTONES (USERID, PATH, SERVERID, ISBACKUP, FILEHASH)
+                      VALUES (?, ?, ?, ?, ?);''',
+                   (file_info[0], file_info[2], file_info[1], file_info[4], file_info[5]))
+    return True
+
+
+def sync_file_infos(server_id, file_list, removed_list, replication='replicated'):
+    connection = get_connection()
+    cursor = connection.cursor()
+    try:
+        with write_lock:
+            cursor.executemany('''DELETE FROM FILES INDEXED BY FILES_USER_PATH
+                                  WHERE USERID = ? AND PATH = ? AND ISBACKUP = ? AND SERVERID = ?;''',
+                               [(user_id, path, is_backup, server_id) for user_id, path, is_backup in removed_list] +
+                               [(file_info[0], file_info[2], file_info[4], server_id) for file_info in file_list])
+            if replication == 'pending':
+                cursor.executemany('DELETE FROM TOMBSTONES WHERE USERID = ? AND PATH = ?;',
+                                   [(file_info[0], file_info[2]) for file_info in file_list])
+            file_list = [file_info for file_info in file_list if not bury_file_info(cursor, file_info)]
+            insert_file_infos(cursor, file_list, replication)
+            for file_info in file_list:
+                cursor.execute('''SELECT COUNT(*), COUNT(*) - SUM(ISBACKUP) FROM FILES INDEXED BY FILES_USER_PATH
+                                    WHERE USERID = ? AND PATH = ?;''', (file_info[0], file_info[2]))
+                copy_count, primary_count = cursor.fetchone()
+                if copy_count > replication_factor or primary_count > 1:
+                    conflicting_files.add((file_info[0], file_info[2]))
+            connection.commit()
+        return True
+    except sqlite3.Error:
+        connection.rollback()
+        return False
+
+
+def set_replication_state(user_id, cloud_file_rel_path, file_hash, replication):
+    connection = get_connection()
+    cursor = connection.cursor()
+    try:
+        with write_lock:
+            cursor.execute('''UPDATE FILES INDEXED BY FILES_USER_PATH SET REPLICATION = ?
+                              WHERE USERID = ? AND PATH = ? AND ISBACKUP = 0 AND FILEHASH = ?;''',
+                           (replication, user_id, cloud_file_rel_path, file_hash))
+            connection.commit()
+        return True
+    except sqlite3.Error:
+        connection.rollback()
+        return False
+
+
+def get_unreplicated_files(server_id):
+    cursor = get_connection().cursor()
+    try:
+        cursor.execute('''SELECT USERID, PATH, FILEHASH FROM FILES INDEXED BY FILES_SERVER
+                            WHERE SERVERID = ? AND ISBACKUP = 0 AND REPLICATION != 'replicated';''', (server_id, ))
+        return cursor.fetchall()
+    except sqlite3.Error:
+        return []
+
+
+def get_server_file_count(server_id):
+    cursor = get_connection().cursor()
+    try:
+        cursor.execute('SELECT COUNT(*) FROM FILES WHERE SERVERID = ?;', (server_id, ))
+        return cursor.fetchone()[0]
+    except sqlite3.Error:
+        return -1
+
+
+def clear_server_files(server_id):
+    connection = get_connection()
+    cursor = connection.cursor()
+    try:
+        with write_lock:
+            cursor.execute('DELETE FROM FILES WHERE SERVERID = ?;', (server_id, ))
+            connection.commit()
+        return True
+    except sqlite3.Error:
+        connection.rollback()
+        return False
+
+
+def get_file_infos(user_id, cloud_file_paths):
+    cursor = get_connection().cursor()
     try:
         all_results = []
-        for dir_path in cloud_dir_paths:
-            cursor.execute('''SELECT FILENAME, LASTMODIFIED FROM FILES 
-                                WHERE ISBACKUP = 0 AND USERID = ? AND PATH LIKE ?;''', (user_id, dir_path + '%'))
+        for paths in batched(list(cloud_file_paths)):
+            placeholders = ', '.join('?' * len(paths))
+            cursor.execute('''SELECT FILENAME, LASTMODIFIED FROM FILES INDEXED BY FILES_USER_PATH
+                                WHERE USERID = ? AND PATH IN ({}) AND ISBACKUP = 0;'''.format(placeholders),
+                           [user_id] + paths)
             all_results += cursor.fetchall()
         return all_results
     except sqlite3.Error:
         return []
 
 
+def get_dir_infos(user_id, cloud_dir_rel_path):
+    cursor = get_connection().cursor()
+    try:
+        cursor.execute('''SELECT FILENAME, LASTMODIFIED FROM FILES INDEXED BY FILES_USER_PARENT
+                            WHERE USERID = ? AND PARENT = ? AND ISBACKUP = 0;''',
+                       (user_id, normalize_path(cloud_dir_rel_path)))
+        return cursor.fetchall()
+    except sqlite3.Error:
+        return []
+
+
 def get_file_backup_servers(server_id, user_id, cloud_file_rel_path):
+    cursor = get_connection().cursor()
     try:
-        cursor.execute('''SELECT ADDRESS FROM FILES JOIN SERVERS USING (SERVERID) 
+        cursor.execute('''SELECT SERVERID, ADDRESS FROM FILES INDEXED BY FILES_USER_PATH JOIN SERVERS USING (SERVERID)
                             WHERE ISBACKUP = 1 AND SERVERID != ? AND USERID = ? AND PATH = ?''',
                        (server_id, user_id, cloud_file_rel_path))
-        results = cursor.fetchall()
-        return [address for (address, ) in results]
+        return get_live_addresses(cursor.fetchall())
     except sqlite3.Error:
         return []
 
 
-def remove_file(user_id, cloud_file_rel_path):
+def get_file_copy_servers(server_id, user_id, cloud_file_rel_path):
+    cursor = get_connection().cursor()
     try:
-        cursor.execute('DELETE FROM FILES WHERE USERID = ? AND PATH = ?;', (user_id, cloud_file_rel_path))
-        connection.commit()
+        cursor.execute('''SELECT SERVERID, ADDRESS, ISBACKUP FROM FILES INDEXED BY FILES_USER_PATH
+                            JOIN SERVERS USING (SERVERID) WHERE SERVERID != ? AND USERID = ? AND PATH = ?''',
+                       (server_id, user_id, cloud_file_rel_path))
+        return [[copy_server_id, address, is_backup, failure_detector.is_alive(copy_server_id)]
+                for copy_server_id, address, is_backup in cursor.fetchall()]
+    except sqlite3.Error:
+        return []
+
+
+def remove_file(user_id, cloud_file_rel_path, pending_server_ids=()):
+    connection = get_connection()
+    cursor = connection.cursor()
+    try:
+        with write_lock:
+            cursor.executemany('''INSERT OR REPLACE INTO TOMBSTONES (USERID, PATH, SERVERID, ISBACKUP, FILEHASH)
+                                  SELECT USERID, PATH, SERVERID, ISBACKUP, COALESCE(FILEHASH, '')
+                                  FROM FILES INDEXED BY FILES_USER_PATH
+                                  WHERE USERID = ? AND PATH = ? AND SERVERID = ?;''',
+                               [(user_id, cloud_file_rel_path, server_id) for server_id in pending_server_ids])
+            cursor.execute('DELETE FROM FILES INDEXED BY FILES_USER_PATH WHERE USERID = ? AND PATH = ?;',
+                           (user_id, cloud_file_rel_path))
+            connection.commit()
         return True
     except sqlite3.Error:
+        connection.rollback()
         return False
 
 
+def remove_tombstone(user_id, cloud_file_rel_path, server_id, is_backup):
+    connection = get_connection()
+    try:
+        with write_lock:
+            connection.execute('''DELETE FROM TOMBSTONES
+                                  WHERE USERID = ? AND PATH = ? AND SERVERID = ? AND ISBACKUP = ?;''',
+                               (user_id, cloud_file_rel_path, server_id, is_backup))
+            connection.commit()
+    except sqlite3.Error:
+        connection.rollback()
+
+
 def get_file_hashes(user_id, cloud_file_rel_path):
+    cursor = get_connection().cursor()
     try:
-        cursor.execute('''SELECT ISBACKUP, FILEHASH, ADDRESS FROM FILES JOIN SERVERS USING (SERVERID) 
-                            WHERE USERID = ? AND PATH = ? ORDER BY ISBACKUP DESC;''', (user_id, cloud_file_rel_path))
+        cursor.execute('''SELECT SERVERID, FILEHASH, ADDRESS FROM FILES INDEXED BY FILES_USER_PATH
+                            JOIN SERVERS USING (SERVERID) WHERE USERID = ? AND PATH = ? ORDER BY ISBACKUP DESC;''',
+                       (user_id, cloud_file_rel_path))
         results = cursor.fetchall()
 
-        return [(file_hash, address) for _, file_hash, address in results]
+        return [(file_hash, address) for server_id, file_hash, address in results
+                if not failure_detector.is_dead(server_id)]
     except sqlite3.Error:
         return []
 
 
-if __name__ == '__main__':
-    server_counter = 0
-    connection = sqlite3.connect('info.db')
-    cursor = connection.cursor()
+def get_replica_sets(user_id, cloud_file_rel_paths, file_hash=''):
+    cursor = get_connection().cursor()
+    try:
+        holders = {normalize_path(path): {} for path in cloud_file_rel_paths}
+        for paths in batched(list(holders)):
+            placeholders = ', '.join('?' * len(paths))
+            cursor.execute('''SELECT PATH, SERVERID, FILEHASH FROM FILES INDEXED BY FILES_USER_PATH
+                                WHERE USERID = ? AND PATH IN ({}) ORDER BY ISBACKUP;'''.format(placeholders),
+                           [user_id] + paths)
+            for path, server_id, holder_hash in cursor.fetchall():
+                if server_id in file_servers and server_id not in holders[path] and \
+                        not failure_detector.is_dead(server_id):
+                    holders[path][server_id] = not file_hash or holder_hash == file_hash
+
+        replica_sets = {}
+        for path, path_holders in holders.items():
+            targets = place_replicas(user_id, path, replication_factor - len(path_holders), list(path_holders))
+            replica_sets[path] = [[file_servers[server_id], current] for server_id, current in path_holders.items()] + \
+                [[file_servers[server_id], False] for server_id in targets]
+        return [replica_sets[normalize_path(path)] for path in cloud_file_rel_paths]
+    except (sqlite3.Error, KeyError):
+        return []
+
+
+def get_replica_set(user_id, cloud_file_rel_path, file_hash=''):
+    replica_sets = get_replica_sets(user_id, [cloud_file_rel_path], file_hash)
+    return replica_sets[0] if replica_sets else []
+
+
+def get_tree_paths(user_id, cloud_dir_rel_path):
+    cursor = get_connection().cursor()
+    prefix = normalize_path(cloud_dir_rel_path)
+    try:
+        if prefix:
+            cursor.execute('''SELECT PATH FROM FILES INDEXED BY FILES_USER_PATH
+                                WHERE USERID = ? AND PATH > ? AND PATH < ? AND ISBACKUP = 0;''',
+                           (user_id, prefix + os.sep, prefix + chr(ord(os.sep) + 1)))
+        else:
+            cursor.execute('''SELECT PATH FROM FILES INDEXED BY FILES_USER_PATH
+                                WHERE USERID = ? AND ISBACKUP = 0;''', (user_id, ))
+        return [path for (path, ) in cursor.fetchall()]
+    except sqlite3.Error:
+        return []
+
+
+def resolve_paths(user_id, cloud_file_rel_paths):
+    cursor = get_connection().cursor()
+    states = {server_id: failure_detector.get_state(server_id) for server_id in list(file_servers)}
+    try:
+        locations = {normalize_path(path): ['', '', []] for path in cloud_file_rel_paths}
+        for paths in batched(list(locations)):
+            placeholders = ', '.join('?' * len(paths))
+            cursor.execute('''SELECT PATH, ISBACKUP, FILEHASH, SERVERID, ADDRESS FROM FILES INDEXED BY FILES_USER_PATH
+                                JOIN SERVERS USING (SERVERID) WHERE USERID = ? AND PATH IN ({})
+                                ORDER BY ISBACKUP, LASTMODIFIED;'''.format(placeholders),
+                           [user_id] + paths)
+            for path, is_backup, file_hash, server_id, address in cursor.fetchall():
+                state = states.get(server_id, DEAD)
+                if not is_backup:
+                    if state != DEAD:
+                        locations[path][0], locations[path][1] = address, file_hash
+                    elif not locations[path][0]:
+                        locations[path][1] = file_hash
+                elif state == ALIVE:
+                    locations[path][2].insert(0, address)
+                elif state == SUSPECT:
+                    locations[path][2].append(address)
+        return [locations[normalize_path(path)] for path in cloud_file_rel_paths]
+    except sqlite3.Error:
+        return []
+
+
+def get_lost_servers():
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT DISTINCT SERVERID FROM FILES INDEXED BY FILES_SERVER;')
+    now = time.monotonic()
+    lost_server_ids = set()
+    for (server_id, ) in cursor.fetchall():
+        if server_id in file_servers:
+            silence = failure_detector.get_silence(server_id)
+        else:
+            silence = now - unregistered_at.setdefault(server_id, now)
+        if silence >= repair_delay:
+            lost_server_ids.add(server_id)
+    return lost_server_ids
+
+
+def find_repair_candidates(lost_server_ids):
+    cursor = get_connection().cursor()
+    candidates = set()
+    for server_ids in batched(list(lost_server_ids)):
+        cursor.execute('''SELECT USERID, PATH FROM FILES INDEXED BY FILES_SERVER
+                            WHERE SERVERID IN ({});'''.format(', '.join('?' * len(server_ids))), server_ids)
+        candidates.update(cursor.fetchall())
+    cursor.execute('''SELECT USERID, PATH FROM FILES INDEXED BY FILES_UNREPLICATED
+                        WHERE ISBACKUP = 0 AND REPLICATION != 'replicated' AND REPLICATION != 'pending';''')
+    candidates.update(cursor.fetchall())
+    return candidates
+
+
+def get_repair_plan(user_id, cloud_file_rel_path, lost_server_ids):
+    cursor = get_connection().cursor()
+    cursor.execute('''SELECT SERVERID, ISBACKUP, FILEHASH FROM FILES INDEXED BY FILES_USER_PATH
+                        WHERE USERID = ? AND PATH = ? ORDER BY ISBACKUP, LASTMODIFIED DESC;''',
+                   (user_id, cloud_file_rel_path))
+    rows = cursor.fetchall()
+    if not rows:
+        return '', [], []
+
+    file_hash = rows[0][2]
+    holders = [(server_id, is_backup) for server_id, is_backup, holder_hash in rows if holder_hash == file_hash and
+               server_id not in lost_server_ids and failure_detector.is_alive(server_id)]
+    return file_hash, holders, [server_id for server_id, _, _ in rows]
+
+
+def remove_lost_rows(user_id, cloud_file_rel_path, lost_server_ids):
+    connection = get_connection()
+    try:
+        with write_lock:
+            connection.executemany('''DELETE FROM FILES INDEXED BY FILES_USER_PATH
+                                      WHERE USERID = ? AND PATH = ? AND SERVERID = ?;''',
+                                   [(user_id, cloud_file_rel_path, server_id) for server_id in lost_server_ids])
+            connection.commit()
+    except sqlite3.Error:
+        connection.rollback()
+
+
+def copy_replicas(user_id, cloud_file_rel_path, holders, targets):
+    source_id, source_is_backup = min(holders, key=lambda holder: server_stats.get(holder[0], (0, 0, 0, 0))[1])
+    for target_id in targets:
+        with proxy_pool.proxy(file_servers[source_id], file_copy_timeout) as file_proxy:
+            copied_bytes = file_proxy.copy_file(user_id, cloud_file_rel_path, bool(source_is_backup),
+                                                file_servers[target_id], repair_bandwidth / repair_workers)
+        if copied_bytes < 0:
+            return False
+        with repair_lock:
+            repair_stats['copied_bytes'] += copied_bytes
+    return True
+
+
+def settle_replicas(user_id, cloud_file_rel_path, file_hash, holders, primary_id, backup_ids):
+    if (primary_id, 0) not in holders:
+        with proxy_pool.proxy(file_servers[primary_id]) as file_proxy:
+            if not file_proxy.promote_file(user_id, cloud_file_rel_path, file_hash):
+                return False
+        holders = [holder for holder in holders if holder != (primary_id, 1)] + [(primary_id, 0)]
+
+    for server_id, is_backup in holders:
+        if server_id == primary_id and not is_backup or server_id in backup_ids and is_backup:
+            continue
+        with proxy_pool.proxy(file_servers[server_id]) as file_proxy:
+            if server_id in backup_ids and (server_id, 1) not in holders:
+                if not file_proxy.demote_file(user_id, cloud_file_rel_path, file_hash):
+                    return False
+            elif not file_proxy.drop_file(user_id, cloud_file_rel_path, bool(is_backup), file_hash):
+                return False
+    return True
+
+
+def repair_file(user_id, cloud_file_rel_path, lost_server_ids):
+    file_hash, holders, server_ids = get_repair_plan(user_id, cloud_file_rel_path, lost_server_ids)
+    if not holders:
+        return 'failed'
+
+    kept_ids = list(dict.fromkeys(server_id for server_id, _ in holders))[:replication_factor]
+    targets = place_replicas(user_id, cloud_file_rel_path, replication_factor - len(kept_ids),
+                             [server_id for server_id, _ in holders] + list(lost_server_ids))
+    copies = holders + [(target_id, 1) for target_id in targets]
+    if not copy_replicas(user_id, cloud_file_rel_path, holders, targets) or \
+            not settle_replicas(user_id, cloud_file_rel_path, file_hash, copies, kept_ids[0], kept_ids[1:] + targets):
+        return 'failed'
+
+    if len(kept_ids) + len(targets) < replication_factor:
+        propose('set_replication_state', user_id, cloud_file_rel_path, file_hash, 'degraded')
+        return 'degraded'
+
+    propose('set_replication_state', user_id, cloud_file_rel_path, file_hash, 'replicated')
+    propose('remove_lost_rows', user_id, cloud_file_rel_path, [server_id for server_id in server_ids
+                                                               if server_id in lost_server_ids])
+    return 'replicated'
+
+
+def find_misplaced_files(lost_server_ids):
+    cursor = get_connection().cursor()
+    cursor.execute('''SELECT USERID, PATH, SERVERID, ISBACKUP, FILEHASH, REPLICATION
+                        FROM FILES INDEXED BY FILES_USER_PATH ORDER BY USERID, PATH, ISBACKUP, LASTMODIFIED DESC;''')
+    misplaced = []
+    for (user_id, cloud_file_rel_path), rows in itertools.groupby(cursor, key=lambda row: row[:2]):
+        rows = list(rows)
+        if rows[0][3] or rows[0][5] != 'replicated' or \
+                any(row[4] != rows[0][4] or row[2] in lost_server_ids or row[2] not in file_servers for row in rows):
+            continue
+        if {row[2] for row in rows} != set(get_ring_servers(user_id, cloud_file_rel_path, lost_server_ids)):
+            misplaced.append((user_id, cloud_file_rel_path))
+    return misplaced
+
+
+def rebalance_file(user_id, cloud_file_rel_path, lost_server_ids):
+    file_hash, holders, _ = get_repair_plan(user_id, cloud_file_rel_path, lost_server_ids)
+    targets = get_ring_servers(user_id, cloud_file_rel_path, lost_server_ids)
+    if not holders or not all(failure_detector.is_alive(server_id) for server_id in targets):
+        return 'failed'
+
+    missing_ids = [target_id for target_id in targets if target_id not in [server_id for server_id, _ in holders]]
+    copies = holders + [(target_id, 1) for target_id in missing_ids]
+    if not copy_replicas(user_id, cloud_file_rel_path, holders, missing_ids) or \
+            not settle_replicas(user_id, cloud_file_rel_path, file_hash, copies, targets[0], targets[1:]):
+        return 'failed'
+    propose('set_replication_state', user_id, cloud_file_rel_path, file_hash, 'replicated')
+    return 'moved'
+
+
+def repair_worker():
+    while True:
+        _, _, action, user_id, cloud_file_rel_path, lost_server_ids = repair_queue.get()
+        with repair_lock:
+            repair_stats['pending'] -= 1
+            repair_stats['active'] += 1
+        try:
+            result = action(user_id, cloud_file_rel_path, lost_server_ids)
+        except (OSError, Fault, ProtocolError, KeyError):
+            result = 'failed'
+        with repair_lock:
+            repair_stats['active'] -= 1
+            repair_stats['repaired' if result == 'replicated' else result] += 1
+            repair_tasks.discard((user_id, cloud_file_rel_path))
+            moving_files.discard((user_id, cloud_file_rel_path))
+
+
+def schedule_repairs():
+    lost_server_ids = get_lost_servers()
+    deficits = []
+    unrecoverable = 0
+    candidates = find_repair_candidates(lost_server_ids)
+    with write_lock:
+        candidates |= conflicting_files
+        conflicting_files.clear()
+    for user_id, cloud_file_rel_path in candidates:
+        file_hash, holders, server_ids = get_repair_plan(user_id, cloud_file_rel_path, lost_server_ids)
+        deficit = replication_factor - len(holders)
+        if not holders:
+            unrecoverable += 1
+            continue
+        if deficit == 0 and sum(not is_backup for _, is_backup in holders) == 1:
+            propose('set_replication_state', user_id, cloud_file_rel_path, file_hash, 'replicated')
+            propose('remove_lost_rows', user_id, cloud_file_rel_path, [server_id for server_id in server_ids
+                                                                       if server_id in lost_server_ids])
+            continue
+        deficits.append((max(deficit, 1), user_id, cloud_file_rel_path))
+
+    with repair_lock:
+        repair_stats['unrecoverable'] = unrecoverable
+        for deficit, user_id, cloud_file_rel_path in deficits:
+            if (user_id, cloud_file_rel_path) not in repair_tasks | moving_files:
+                repair_tasks.add((user_id, cloud_file_rel_path))
+                repair_stats['pending'] += 1
+                repair_queue.put((-deficit, next(repair_counter), repair_file, user_id, cloud_file_rel_path,
+                                  lost_server_ids))
+
+        if repair_tasks and not repair_stats['degraded_since']:
+            repair_stats['degraded_since'] = time.time()
+            print('Scheduled repairs for {} under-replicated files.'.format(len(repair_tasks)))
+        elif not repair_tasks and repair_stats['degraded_since']:
+            repair_stats['last_time_to_redundancy'] = time.time() - repair_stats['degraded_since']
+            repair_stats['degraded_since'] = 0
+            print('Restored full redundancy in {:.1f} s.'.format(repair_stats['last_time_to_redundancy']))
+
+
+def schedule_rebalance():
+    global balanced_version
+    lost_server_ids = get_lost_servers()
+    version = placement_ring.version, membership_version, lost_server_ids
+    if version == balanced_version or repair_tasks or moving_files or \
+            any(server_id not in lost_server_ids and not failure_detector.is_alive(server_id)
+                for server_id in list(file_servers)):
+        return
+
+    misplaced = find_misplaced_files(lost_server_ids)
+    with repair_lock:
+        if not misplaced and repair_stats['misplaced']:
+            print('Moved {} files onto the placement ring.'.format(repair_stats['moved']))
+        repair_stats['misplaced'] = len(misplaced)
+        for user_id, cloud_file_rel_path in misplaced:
+            moving_files.add((user_id, cloud_file_rel_path))
+            repair_stats['pending'] += 1
+            repair_queue.put((1, next(repair_counter), rebalance_file, user_id, cloud_file_rel_path,
+                              lost_server_ids))
+    if not misplaced:
+        balanced_version = version
+    else:
+        print('Rebalancing {} files onto the placement ring.'.format(len(misplaced)))
+
+
+def clear_tombstones():
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT USERID, PATH, SERVERID, ISBACKUP, FILEHASH FROM TOMBSTONES;')
+    for user_id, cloud_file_rel_path, server_id, is_backup, file_hash in cursor.fetchall():
+        if not failure_detector.is_alive(server_id):
+            continue
+        try:
+            with proxy_pool.proxy(file_servers[server_id]) as file_proxy:
+                file_proxy.drop_file(user_id, cloud_file_rel_path, bool(is_backup), file_hash)
+        except (OSError, Fault, ProtocolError, KeyError):
+            continue
+        propose('remove_tombstone', user_id, cloud_file_rel_path, server_id, is_backup)
+
+
+def repair_loop():
+    while True:
+        time.sleep(repair_interval)
+        if not raft_node.has_lease():
+            continue
+        try:
+            schedule_repairs()
+            schedule_rebalance()
+            clear_tombstones()
+        except (sqlite3.Error, Fault):
+            pass
+
+
+def get_repair_status():
+    with repair_lock:
+        return dict(repair_stats)
+
+
+write_functions = {function.__name__: function for function in
+                   (save_user, register_file_server, unregister_file_server, save_file_info, sync_file_infos,
+                    set_replication_state, clear_server_files, remove_file, remove_lost_rows, remove_tombstone)}
+
+
+def save_request(request_id, result):
+    connection = get_connection()
+    cursor = connection.execute('INSERT INTO REQUESTS (REQUESTID, RESULT) VALUES (?, ?);',
+                                (request_id, json.dumps(result)))
+    connection.execute('DELETE FROM REQUESTS WHERE ROWID <= ?;', (cursor.lastrowid - raft_request_history, ))
+
+
+def apply_command(name, params, request_id=''):
+    connection = get_connection()
+    if request_id:
+        row = connection.execute('SELECT RESULT FROM REQUESTS WHERE REQUESTID = ?;', (request_id, )).fetchone()
+        if row:
+            return json.loads(row[0])
+
+    local.connection = ApplyConnection(connection)
+    try:
+        result = write_functions[name](*params)
+    except sqlite3.Error:
+        local.connection.rollback()
+        result = False
+    finally:
+        local.connection.release()
+        local.connection = connection
+    if request_id:
+        save_request(request_id, result)
+    return result
+
+
+def propose(name, *params):
+    return raft_node.submit(name, params)
+
+
+def replicated(function):
+    def submit(*params):
+        return raft_node.submit(function.__name__, params)
+    return submit
+
+
+def leased(function):
+    def read(*params):
+        raft_node.check_lease()
+        return function(*params)
+    return read
+
+
+def submit_request(request_id, name, params):
+    if name not in write_functions:
+        raise Fault(1, 'command "{}" is not supported'.format(name))
+    return raft_node.submit(name, params, request_id)
+
+
+def get_raft_status():
+    return raft_node.get_status()
+
+
+def serve(server_address, replica_urls, replica):
+    global raft_node
     init_db()
-    with SimpleXMLRPCServer(name_server_info, allow_none=True) as server:
-        server.register_function(get_next_server)
-        server.register_function(save_user)
-        server.register_function(get_user_credentials)
-        server.register_function(get_server_addresses)
-        server.register_function(register_file_server)
-        server.register_function(unregister_file_server)
-        server.register_function(save_file_info)
-        server.register_function(get_file_infos)
-        server.register_function(get_file_backup_servers)
-        server.register_function(remove_file)
-        server.register_function(get_file_hashes)
+    raft_node = RaftNode(replica, replica_urls, get_connection, apply_command, raft_election_timeout,
+                         raft_heartbeat_interval, raft_lease_duration, raft_batch_size if raft_batching else 1)
+    with make_server(server_address, allow_none=True, threaded=True) as server:
+        for function in (save_user, register_file_server, unregister_file_server, save_file_info, sync_file_infos,
+                         set_replication_state, clear_server_files, remove_file):
+            server.register_function(replicated(function), function.__name__)
+        for function in (get_next_server, get_user_credentials, get_server_addresses, get_server_file_count,
+                         get_unreplicated_files, get_file_infos, get_dir_infos, get_file_backup_servers,
+                         get_file_copy_servers, get_file_hashes, resolve_paths, get_replica_set, get_replica_sets,
+                         get_tree_paths, get_server_states, get_repair_status):
+            server.register_function(leased(function), function.__name__)
+        server.register_function(heartbeat)
+        server.register_function(raft_node.request_vote, 'request_vote')
+        server.register_function(raft_node.append_entries, 'append_entries')
+        server.register_function(submit_request)
+        server.register_function(get_raft_status)
+        raft_node.start()
+        for _ in range(repair_workers):
+            threading.Thread(target=repair_worker, daemon=True).start()
+        threading.Thread(target=repair_loop, daemon=True).start()
         try:
             server.serve_forever()
         except KeyboardInterrupt:
-            connection.close()
+            get_connection().close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('shard', help='Index of the shard in name_server_shards.', type=int, nargs='?', default=0)
+    parser.add_argument('replica', help='Index of the replica within the shard.', type=int, nargs='?', default=0)
+    args = parser.parse_args()
+
+    name_server_info, name_server_db = name_server_shards[args.shard][args.replica]
+    shard_index, shard_count = args.shard, len(name_server_shards)
+    serve(name_server_info, name_server_urls[args.shard], args.replica)
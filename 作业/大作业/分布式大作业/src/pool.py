@@ -0,0 +1,121 @@
+import time
+import threading
+from contextlib import contextmanager
+from xmlrpc.client import Fault, ProtocolError
+from transport import connect
+from config import pool_max_idle, pool_idle_timeout, pool_health_check_interval, file_server_timeout
+
+
+def close_proxy(proxy):
+    try:
+        proxy('close')()
+    except OSError:
+        pass
+
+
+class ProxyPool(object):
+    def __init__(self, max_idle, idle_timeout, health_check_interval, default_timeout):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.default_timeout = default_timeout
+        self.idle = {}
+        self.timeouts = {}
+        self.lock = threading.Lock()
+        self.last_eviction = time.monotonic()
+
+    def is_healthy(self, proxy):
+        try:
+            return proxy.ping()
+        except (OSError, Fault, ProtocolError):
+            return False
+
+    def acquire(self, address):
+        while True:
+            with self.lock:
+                entries = self.idle.get(address)
+                if not entries:
+                    break
+                proxy, last_used = entries.pop()
+
+            idle_time = time.monotonic() - last_used
+            if idle_time > self.idle_timeout:
+                close_proxy(proxy)
+            elif idle_time > self.health_check_interval and not self.is_healthy(proxy):
+                close_proxy(proxy)
+            else:
+                return proxy
+
+        return connect(address, self.timeouts.get(address, self.default_timeout))
+
+    def set_timeout(self, address, timeout):
+        self.timeouts[address] = timeout
+
+    def release(self, address, proxy):
+        now = time.monotonic()
+        with self.lock:
+            entries = self.idle.setdefault(address, [])
+            if len(entries) < self.max_idle:
+                entries.append((proxy, now))
+                proxy = None
+
+        if proxy is not None:
+            close_proxy(proxy)
+        if now - self.last_eviction > self.idle_timeout:
+            self.evict_idle()
+
+    def evict_idle(self):
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            self.last_eviction = now
+            for address, entries in self.idle.items():
+                expired += [proxy for proxy, last_used in entries if now - last_used > self.idle_timeout]
+                entries[:] = [(proxy, last_used) for proxy, last_used in entries
+                              if now - last_used <= self.idle_timeout]
+
+        for proxy in expired:
+            close_proxy(proxy)
+
+    @contextmanager
+    def proxy(self, address, timeout=None):
+        if timeout is not None:
+            proxy = connect(address, timeout)
+            try:
+                yield proxy
+            finally:
+                close_proxy(proxy)
+            return
+
+        proxy = self.acquire(address)
+        try:
+            yield proxy
+        except Fault:
+            self.release(address, proxy)
+            raise
+        except BaseException:
+            close_proxy(proxy)
+            raise
+        self.release(address, proxy)
+
+    def close(self):
+        with self.lock:
+            entries = [proxy for proxies in self.idle.values() for proxy, _ in proxies]
+            self.idle.clear()
+
+        for proxy in entries:
+            close_proxy(proxy)
+
+
+class PooledProxy(object):
+    def __init__(self, address):
+        self.address = address
+
+    def __getattr__(self, name):
+        def call(*params):
+            with proxy_pool.proxy(self.address) as proxy:
+                return getattr(proxy, name)(*params)
+        return call
+
+
+proxy_pool = ProxyPool(pool_max_idle, pool_idle_timeout, pool_health_check_interval, file_server_timeout)
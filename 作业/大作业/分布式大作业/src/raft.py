@@ -0,0 +1,334 @@
+import json
+import time
+import random
+import threading
+from xmlrpc.client import Fault, ProtocolError
+from transport import NOT_LEADER_FAULT
+from pool import proxy_pool
+
+FOLLOWER = 'follower'
+CANDIDATE = 'candidate'
+LEADER = 'leader'
+
+
+class RaftNode(object):
+    def __init__(self, node_id, addresses, get_connection, apply, election_timeout, heartbeat_interval,
+                 lease_duration, batch_size):
+        self.node_id = node_id
+        self.addresses = list(addresses)
+        self.peers = [peer for peer in range(len(self.addresses)) if peer != node_id]
+        self.get_connection = get_connection
+        self.apply = apply
+        self.election_timeout = election_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.lease_duration = lease_duration
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.appended = threading.Condition(self.lock)
+        self.committed = threading.Condition(self.lock)
+        self.applied = threading.Condition(self.lock)
+        self.role = FOLLOWER
+        self.leader_id = None
+        self.current_term = 0
+        self.voted_for = None
+        self.votes = set()
+        self.log = [(0, '')]
+        self.persisted_index = 0
+        self.commit_index = 0
+        self.last_applied = 0
+        self.term_start_index = 0
+        self.waiting = set()
+        self.results = {}
+        self.next_index = {}
+        self.match_index = {}
+        self.acked_at = {}
+        self.heartbeat_due = {}
+        self.last_contact = None
+        self.election_deadline = 0
+        for peer in self.peers:
+            proxy_pool.set_timeout(self.addresses[peer], election_timeout)
+
+    def load(self):
+        connection = self.get_connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS RAFT_STATE (ID INTEGER PRIMARY KEY CHECK (ID = 0), '
+                           'CURRENTTERM INTEGER NOT NULL, VOTEDFOR INTEGER, LASTAPPLIED INTEGER NOT NULL);')
+        connection.execute('CREATE TABLE IF NOT EXISTS RAFT_LOG (LOGINDEX INTEGER PRIMARY KEY, '
+                           'TERM INTEGER NOT NULL, COMMAND TEXT NOT NULL);')
+        connection.execute('INSERT OR IGNORE INTO RAFT_STATE (ID, CURRENTTERM, VOTEDFOR, LASTAPPLIED) '
+                           'VALUES (0, 0, NULL, 0);')
+        connection.commit()
+        self.current_term, self.voted_for, self.last_applied = connection.execute(
+            'SELECT CURRENTTERM, VOTEDFOR, LASTAPPLIED FROM RAFT_STATE WHERE ID = 0;').fetchone()
+        self.log += connection.execute('SELECT TERM, COMMAND FROM RAFT_LOG ORDER BY LOGINDEX;').fetchall()
+        self.persisted_index = len(self.log) - 1
+        self.commit_index = self.last_applied
+
+    def start(self):
+        self.load()
+        with self.lock:
+            self.reset_election_deadline()
+            if not self.peers:
+                self.start_election()
+
+        threading.Thread(target=self.election_loop, daemon=True).start()
+        threading.Thread(target=self.persist_loop, daemon=True).start()
+        threading.Thread(target=self.apply_loop, daemon=True).start()
+        for peer in self.peers:
+            threading.Thread(target=self.replicate_loop, args=(peer, ), daemon=True).start()
+
+    def save_state(self):
+        connection = self.get_connection()
+        connection.execute('UPDATE RAFT_STATE SET CURRENTTERM = ?, VOTEDFOR = ? WHERE ID = 0;',
+                           (self.current_term, self.voted_for))
+        connection.commit()
+
+    def persist_log(self, limit=None):
+        first = self.persisted_index + 1
+        entries = self.log[first:first + limit] if limit else self.log[first:]
+        connection = self.get_connection()
+        connection.execute('DELETE FROM RAFT_LOG WHERE LOGINDEX >= ?;', (first, ))
+        connection.executemany('INSERT INTO RAFT_LOG (LOGINDEX, TERM, COMMAND) VALUES (?, ?, ?);',
+                               [(first + offset, term, command) for offset, (term, command) in enumerate(entries)])
+        connection.commit()
+        self.persisted_index = first + len(entries) - 1
+
+    def get_leader_address(self):
+        return '' if self.leader_id is None else self.addresses[self.leader_id]
+
+    def reset_election_deadline(self):
+        self.election_deadline = time.monotonic() + self.election_timeout * (1 + random.random())
+
+    def get_majority(self):
+        return len(self.addresses) // 2 + 1
+
+    def step_down(self, term):
+        if term > self.current_term:
+            self.current_term = term
+            self.voted_for = None
+            self.save_state()
+        if self.role != FOLLOWER:
+            self.role = FOLLOWER
+            self.leader_id = None
+        self.reset_election_deadline()
+        self.applied.notify_all()
+
+    def start_election(self):
+        self.role = CANDIDATE
+        self.current_term += 1
+        self.voted_for = self.node_id
+        self.votes = {self.node_id}
+        self.leader_id = None
+        self.save_state()
+        self.reset_election_deadline()
+        if len(self.votes) >= self.get_majority():
+            self.become_leader()
+            return
+
+        request = (self.current_term, self.node_id, len(self.log) - 1, self.log[-1][0])
+        for peer in self.peers:
+            threading.Thread(target=self.request_peer_vote, args=(peer, request), daemon=True).start()
+
+    def request_peer_vote(self, peer, request):
+        try:
+            with proxy_pool.proxy(self.addresses[peer]) as proxy:
+                term, granted = proxy.request_vote(*request)
+        except (OSError, Fault, ProtocolError):
+            return
+
+        with self.lock:
+            if term > self.current_term:
+                self.step_down(term)
+            elif granted and self.role == CANDIDATE and self.current_term == request[0]:
+                self.votes.add(peer)
+                if len(self.votes) >= self.get_majority():
+                    self.become_leader()
+
+    def become_leader(self):
+        self.role = LEADER
+        self.leader_id = self.node_id
+        now = time.monotonic()
+        for peer in self.peers:
+            self.next_index[peer] = len(self.log)
+            self.match_index[peer] = 0
+            self.acked_at[peer] = None
+            self.heartbeat_due[peer] = now
+        self.log.append((self.current_term, ''))
+        self.term_start_index = len(self.log) - 1
+        self.appended.notify_all()
+
+    def advance_commit(self):
+        if self.role != LEADER:
+            return
+        matched = sorted([self.persisted_index] + [self.match_index[peer] for peer in self.peers], reverse=True)
+        index = matched[self.get_majority() - 1]
+        if index > self.commit_index and self.log[index][0] == self.current_term:
+            self.commit_index = index
+            self.committed.notify()
+
+    def holds_lease(self):
+        if self.role != LEADER or self.last_applied < self.term_start_index:
+            return False
+        if not self.peers:
+            return True
+        acked = sorted((self.acked_at[peer] for peer in self.peers if self.acked_at[peer] is not None), reverse=True)
+        quorum = self.get_majority() - 1
+        return len(acked) >= quorum and acked[quorum - 1] + self.lease_duration > time.monotonic()
+
+    def has_lease(self):
+        with self.lock:
+            return self.holds_lease()
+
+    def check_lease(self):
+        with self.lock:
+            if not self.holds_lease():
+                raise Fault(NOT_LEADER_FAULT, self.get_leader_address())
+
+    def submit(self, name, params, request_id=''):
+        command = json.dumps([name, params, request_id] if request_id else [name, params])
+        with self.lock:
+            if self.role != LEADER:
+                raise Fault(NOT_LEADER_FAULT, self.get_leader_address())
+            term = self.current_term
+            self.log.append((term, command))
+            index = len(self.log) - 1
+            self.waiting.add(index)
+            self.appended.notify_all()
+
+            deadline = time.monotonic() + self.election_timeout * 2
+            while self.last_applied < index and self.role == LEADER and self.current_term == term:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                self.applied.wait(timeout)
+
+            self.waiting.discard(index)
+            result = self.results.pop(index, None)
+            if self.last_applied >= index and self.log[index][0] == term:
+                return result
+            raise Fault(NOT_LEADER_FAULT, self.get_leader_address())
+
+    def request_vote(self, term, candidate_id, last_log_index, last_log_term):
+        with self.lock:
+            if term > self.current_term:
+                if self.holds_lease() or (self.role == FOLLOWER and self.last_contact is not None and
+                                          time.monotonic() - self.last_contact < self.election_timeout):
+                    return self.current_term, False
+                self.step_down(term)
+
+            up_to_date = (last_log_term, last_log_index) >= (self.log[-1][0], len(self.log) - 1)
+            if term == self.current_term and self.voted_for in (None, candidate_id) and up_to_date:
+                self.voted_for = candidate_id
+                self.save_state()
+                self.reset_election_deadline()
+                return self.current_term, True
+            return self.current_term, False
+
+    def append_entries(self, term, leader_id, prev_log_index, prev_log_term, entries, leader_commit):
+        with self.lock:
+            if term < self.current_term:
+                return self.current_term, False, len(self.log) - 1
+            if term > self.current_term or self.role != FOLLOWER:
+                self.step_down(term)
+            self.leader_id = leader_id
+            self.last_contact = time.monotonic()
+            self.reset_election_deadline()
+
+            if prev_log_index >= len(self.log) or self.log[prev_log_index][0] != prev_log_term:
+                return self.current_term, False, min(len(self.log), prev_log_index) - 1
+
+            for offset, (entry_term, command) in enumerate(entries):
+                index = prev_log_index + 1 + offset
+                if index < len(self.log):
+                    if self.log[index][0] == entry_term:
+                        continue
+                    del self.log[index:]
+                    self.persisted_index = min(self.persisted_index, index - 1)
+                self.log.append((entry_term, command))
+            if self.persisted_index < len(self.log) - 1:
+                self.persist_log()
+
+            last_index = prev_log_index + len(entries)
+            if min(leader_commit, last_index) > self.commit_index:
+                self.commit_index = min(leader_commit, last_index)
+                self.committed.notify()
+            return self.current_term, True, last_index
+
+    def get_status(self):
+        with self.lock:
+            return {'node': self.node_id, 'role': self.role, 'term': self.current_term,
+                    'leader': self.get_leader_address(), 'log_length': len(self.log) - 1,
+                    'commit_index': self.commit_index, 'last_applied': self.last_applied,
+                    'lease': self.holds_lease()}
+
+    def election_loop(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self.lock:
+                if self.role != LEADER and time.monotonic() >= self.election_deadline:
+                    self.start_election()
+
+    def persist_loop(self):
+        while True:
+            with self.lock:
+                while self.persisted_index >= len(self.log) - 1:
+                    self.appended.wait()
+                self.persist_log(self.batch_size)
+                self.advance_commit()
+
+    def replicate_loop(self, peer):
+        while True:
+            with self.lock:
+                while True:
+                    if self.role == LEADER:
+                        wait = self.heartbeat_due[peer] - time.monotonic()
+                        if self.next_index[peer] < len(self.log) or wait <= 0:
+                            break
+                        self.appended.wait(wait)
+                    else:
+                        self.appended.wait()
+
+                term = self.current_term
+                next_index = self.next_index[peer]
+                entries = [list(entry) for entry in self.log[next_index:next_index + self.batch_size]]
+                request = (term, self.node_id, next_index - 1, self.log[next_index - 1][0], entries,
+                           self.commit_index)
+                self.heartbeat_due[peer] = time.monotonic() + self.heartbeat_interval
+
+            sent_at = time.monotonic()
+            try:
+                with proxy_pool.proxy(self.addresses[peer]) as proxy:
+                    reply_term, success, last_index = proxy.append_entries(*request)
+            except (OSError, Fault, ProtocolError):
+                time.sleep(self.heartbeat_interval)
+                continue
+
+            with self.lock:
+                if reply_term > self.current_term:
+                    self.step_down(reply_term)
+                elif self.role == LEADER and self.current_term == term:
+                    if success:
+                        self.match_index[peer] = max(self.match_index[peer], last_index)
+                        self.next_index[peer] = max(self.next_index[peer], last_index + 1)
+                        self.acked_at[peer] = max(self.acked_at[peer] or sent_at, sent_at)
+                        self.advance_commit()
+                    else:
+                        self.next_index[peer] = max(1, min(next_index - 1, last_index + 1))
+
+    def apply_loop(self):
+        while True:
+            with self.lock:
+                while self.last_applied >= self.commit_index:
+                    self.committed.wait()
+                first = self.last_applied + 1
+                entries = self.log[first:min(self.commit_index + 1, first + self.batch_size)]
+
+            connection = self.get_connection()
+            connection.execute('UPDATE RAFT_STATE SET LASTAPPLIED = ? WHERE ID = 0;', (first + len(entries) - 1, ))
+            results = [self.apply(*json.loads(command)) if command else None for _, command in entries]
+            connection.commit()
+            with self.lock:
+                self.last_applied = first + len(entries) - 1
+                for index, result in enumerate(results, first):
+                    if index in self.waiting:
+                        self.results[index] = result
+                self.applied.notify_all()
@@ -0,0 +1,55 @@
+import bisect
+import hashlib
+import threading
+
+
+class HashRing(object):
+    def __init__(self, virtual_nodes):
+        self.virtual_nodes = virtual_nodes
+        self.points = []
+        self.owners = []
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def get_point(self, key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def rebuild(self, nodes):
+        nodes.sort()
+        self.points = [point for point, _ in nodes]
+        self.owners = [server_id for _, server_id in nodes]
+        self.version += 1
+
+    def add(self, server_id):
+        with self.lock:
+            if server_id in self.owners:
+                return
+            self.rebuild(list(zip(self.points, self.owners)) +
+                         [(self.get_point('{}#{}'.format(server_id, index)), server_id)
+                          for index in range(self.virtual_nodes)])
+
+    def remove(self, server_id):
+        with self.lock:
+            if server_id not in self.owners:
+                return
+            self.rebuild([(point, owner) for point, owner in zip(self.points, self.owners) if owner != server_id])
+
+    def get_servers(self, key, count, accept=None):
+        with self.lock:
+            points, owners = self.points, self.owners
+        servers = []
+        seen = set()
+        if count <= 0 or not points:
+            return servers
+
+        start = bisect.bisect(points, self.get_point(key))
+        for index in range(len(points)):
+            owner = owners[(start + index) % len(points)]
+            if owner in seen:
+                continue
+            seen.add(owner)
+            if accept is None or accept(owner):
+                servers.append(owner)
+                if len(servers) == count:
+                    break
+        return servers
@@ -1,15 +1,29 @@
-from xmlrpc.client import ServerProxy, Binary
+from xmlrpc.client import Fault, MultiCall, ProtocolError
 import base64
 import bcrypt
 from pathlib import Path
-from config import name_server_url
+from config import name_server_urls, fan_out_workers, fan_out_timeout, busy_retries, busy_backoff, \
+    content_cache_dir, content_cache_size, listing_cache_ttl, sync_replication, stripe_min_size, delta_sync, \
+    transfer_retries, bulk_transfer_workers, bulk_batch_size
 import argparse
 import datetime
 import os
-from cryptography.fernet import Fernet
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+import time
+import tempfile
+import concurrent.futures
+from transfer import hash_file, send_file, send_delta, receive_file, receive_striped_file
+from pool import proxy_pool
+from shards import ShardedProxy
+from transport import BUSY_FAULT
+from cache import ContentCache, ListingCache
+from balancer import replica_selector
+from keys import KeyManager
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import InvalidToken
+
+fan_out_executor = concurrent.futures.ThreadPoolExecutor(max_workers=fan_out_workers)
+content_cache = ContentCache(content_cache_dir, content_cache_size)
+listing_cache = ListingCache(listing_cache_ttl)
 
 
 def sign_up(username, password):
@@ -36,32 +50,92 @@ def login(username, password):
 
         if bcrypt.checkpw(bytes(password, 'utf-8'), hash_password):
             print('Logged in as {}.'.format(username))
-            return App(user_id, username)
+            return App(user_id, username, KeyManager(results[1], results[2]))
         else:
             print('Wrong password.')
     return None
 
 
-def list_file_names(user_id, cloud_file_path):
+def call_server(address, method, params):
+    for attempt in range(busy_retries):
+        try:
+            with proxy_pool.proxy(address) as new_proxy:
+                return getattr(new_proxy, method)(*params)
+        except Fault as fault:
+            if fault.faultCode != BUSY_FAULT or attempt == busy_retries - 1:
+                raise
+            time.sleep(busy_backoff * 2 ** attempt)
+
+
+def multi_call(address, *calls):
+    with proxy_pool.proxy(address) as new_proxy:
+        pipeline = MultiCall(new_proxy)
+        for method, params in calls:
+            getattr(pipeline, method)(*params)
+        results = tuple(pipeline())
+    return results
+
+
+def resolve_file(user_id, cloud_file_path):
+    locations = proxy.resolve_paths(user_id, [cloud_file_path])
+    return locations[0] if locations else ('', '', [])
+
+
+def query_servers(addresses, method, *params):
+    futures = {fan_out_executor.submit(call_server, address, method, params): address for address in addresses}
+    done, _ = concurrent.futures.wait(futures, timeout=fan_out_timeout)
+    return [(futures[future], future.result()) for future in done if future.exception() is None]
+
+
+def find_server(addresses, accept, method, *params):
+    futures = {fan_out_executor.submit(call_server, address, method, params): address for address in addresses}
+    try:
+        for future in concurrent.futures.as_completed(futures, timeout=fan_out_timeout):
+            if future.exception() is None and accept(future.result()):
+                return futures[future], future.result()
+    except concurrent.futures.TimeoutError:
+        pass
+    return None, None
+
+
+def path_is_present(path_info):
+    path_valid, path_exists, rel_path_str = path_info
+    return path_valid and path_exists
+
+
+def find_existing_servers(user_id, cloud_path):
+    addresses = proxy.get_server_addresses(user_id)
+    return [address for address, path_info in query_servers(addresses, 'path_check', user_id, cloud_path)
+            if path_is_present(path_info)]
+
+
+def get_listing(user_id, cloud_file_path):
+    listing = listing_cache.get(user_id, cloud_file_path)
+    if listing is not None:
+        return listing
+
     addresses = proxy.get_server_addresses(user_id)
     dir_paths = set()
-    info_queries = set()
+    for _, file_paths in query_servers(addresses, 'get_filenames', user_id, cloud_file_path):
+        for is_dir, file_path in file_paths:
+            if is_dir:
+                dir_paths.add(file_path)
+
+    listing = dir_paths, proxy.get_dir_infos(user_id, cloud_file_path)
+    listing_cache.put(user_id, cloud_file_path, listing)
+    return listing
+
+
+def list_file_names(user_id, cloud_file_path):
+    dir_paths, file_infos = get_listing(user_id, cloud_file_path)
     print('=' * 80)
     print('{0:45s} {1:7s} {2}'.format('File Name', 'Type', 'Last Update'))
     print('=' * 80)
 
-    for address in addresses:
-        with ServerProxy(address, allow_none=True) as new_proxy:
-            for is_dir, file_path in new_proxy.get_filenames(user_id, cloud_file_path):
-                if is_dir:
-                    dir_paths.add(file_path)
-                else:
-                    info_queries.add(file_path)
-
     for dir_path in dir_paths:
         print('{0:45s} <DIR>'.format(Path(dir_path).name + '/'))
 
-    for file_name, mod_date in proxy.get_file_infos(user_id, list(info_queries)):
+    for file_name, mod_date in file_infos:
         print('{0:45s} {1:7s} {2}'.format(file_name, Path(file_name).suffix[1:].upper(),
                                           datetime.datetime.fromtimestamp(mod_date)))
 
@@ -69,157 +143,319 @@ def list_file_names(user_id, cloud_file_path):
 
 
 def can_change_dir(user_id, cloud_dir_path):
-    for address in proxy.get_server_addresses(user_id):
-        with ServerProxy(address, allow_none=True) as new_proxy:
-            path_valid, path_exists, rel_path_str = new_proxy.path_check(user_id, cloud_dir_path)
-        if not path_valid:
-            return False, ''
-        elif path_exists:
-            return True, rel_path_str
-    return False, ''
+    addresses = proxy.get_server_addresses(user_id)
+    address, path_info = find_server(addresses, lambda info: not info[0] or info[1],
+                                     'path_check', user_id, cloud_dir_path)
+    if address is None or not path_info[0]:
+        return False, ''
+    return True, path_info[2]
 
 
 def make_dirs(user_id, cloud_dir_path):
     addresses = proxy.get_server_addresses(user_id)
-    exists = False
-    for address in addresses:
-        with ServerProxy(address, allow_none=True) as new_proxy:
-            path_valid, path_exists, rel_path_str = new_proxy.path_check(user_id, cloud_dir_path)
-            if path_valid and path_exists:
-                exists = True
-    if exists:
+    address, _ = find_server(addresses, path_is_present, 'path_check', user_id, cloud_dir_path)
+    if address is not None:
         return False
     address = proxy.get_next_server()
-    with ServerProxy(address, allow_none=True) as new_proxy:
+    with proxy_pool.proxy(address) as new_proxy:
         made = new_proxy.make_dirs(user_id, cloud_dir_path)
+    listing_cache.invalidate(user_id)
     return made
 
 
 def del_dir(user_id, cloud_dir_path):
-    addresses = proxy.get_server_addresses(user_id)
-    for address in addresses:
-        with ServerProxy(address, allow_none=True) as new_proxy:
-            path_valid, path_exists, rel_path_str = new_proxy.path_check(user_id, cloud_dir_path)
-            if path_valid and path_exists:
-                if not new_proxy.delete_empty_dir(user_id, cloud_dir_path):
-                    return False
-    return True
+    existing_servers = find_existing_servers(user_id, cloud_dir_path)
+    results = query_servers(existing_servers, 'delete_empty_dir', user_id, cloud_dir_path)
+    listing_cache.invalidate(user_id)
+    return len(results) == len(existing_servers) and all(deleted for _, deleted in results)
 
 
-def delete_file(user_id, cloud_file_path):
-    addresses = proxy.get_server_addresses(user_id)
-    existing_servers = []
-    for address in addresses:
-        with ServerProxy(address, allow_none=True) as new_proxy:
-            path_valid, path_exists, rel_path_str = new_proxy.path_check(user_id, cloud_file_path)
-            if path_valid and path_exists:
-                existing_servers.append(address)
-    if len(existing_servers) != 1:
-        return False
-    with ServerProxy(existing_servers[0], allow_none=True) as new_proxy:
+def delete_file_at(address, user_id, cloud_file_path):
+    with proxy_pool.proxy(address) as new_proxy:
         success = new_proxy.delete_file(user_id, cloud_file_path)
+    listing_cache.invalidate(user_id)
+    content_cache.invalidate(user_id, cloud_file_path)
     return success
 
 
-def upload_file(user_id, file_bin, cloud_file_path, filename):
-    addresses = proxy.get_server_addresses(user_id)
-    file_path_with_filename = str(Path(cloud_file_path) / filename)
+def delete_file(user_id, cloud_file_path):
+    address, _, _ = resolve_file(user_id, cloud_file_path)
+    if not address:
+        return False
+    return delete_file_at(address, user_id, cloud_file_path)
 
-    existing_servers = []
-    for address in addresses:
-        with ServerProxy(address, allow_none=True) as new_proxy:
-            path_valid, path_exists, rel_path_str = new_proxy.path_check(user_id, file_path_with_filename)
 
-            if path_valid and path_exists:
-                existing_servers.append(address)
+def upload_file(user_id, local_path, cloud_file_path, filename):
+    file_path_with_filename = str(Path(cloud_file_path) / filename)
+    locations, replica_set = proxy.get_user_group(user_id).call(
+        multi_call, ('resolve_paths', (user_id, [file_path_with_filename])),
+        ('get_replica_set', (user_id, file_path_with_filename)))
 
-    if len(existing_servers) > 1:
+    if not locations or not replica_set:
+        return False
+    if not locations[0][0] and not call_server(replica_set[0][0], 'make_dir_tree', (user_id, [cloud_file_path])):
         return False
-    elif len(existing_servers) == 1:
-        deleted = delete_file(user_id, file_path_with_filename)
+    return upload_to_replicas(user_id, local_path, cloud_file_path, filename, locations[0], replica_set)
+
+
+def upload_to_replicas(user_id, local_path, cloud_file_path, filename, location, replica_set):
+    file_path_with_filename = str(Path(cloud_file_path) / filename)
+    if location[0]:
+        if delta_sync and send_delta(location[0], user_id, local_path, file_path_with_filename, location[1],
+                                     sync_replication):
+            content_cache.invalidate(user_id, file_path_with_filename)
+            listing_cache.invalidate(user_id)
+            return True
+
+        deleted = delete_file_at(location[0], user_id, file_path_with_filename)
 
         if not deleted:
             return False
 
-    address = proxy.get_next_server()
+    uploaded = send_file(replica_set[0][0], user_id, local_path, cloud_file_path, filename,
+                         sync_replication=sync_replication)
+    listing_cache.invalidate(user_id)
+    return uploaded
+
+
+def fetch_from_replica(address, backup, user_id, cloud_file_path):
+    with replica_selector.track(address):
+        return call_server(address, 'fetch_file', (user_id, cloud_file_path, backup))
+
+
+def wait_for_location(futures, timeout, file_hash=''):
+    deadline = time.monotonic() + timeout
+    while futures:
+        done, _ = concurrent.futures.wait(futures, timeout=max(0, deadline - time.monotonic()),
+                                          return_when=concurrent.futures.FIRST_COMPLETED)
+        if not done:
+            return None
+        for future in done:
+            futures.remove(future)
+            if future.exception() is None and future.result()[0] and \
+                    (not file_hash or future.result()[4] == file_hash):
+                return future.result()
+    return None
 
-    with ServerProxy(address, allow_none=True) as new_proxy:
-        added = new_proxy.upload_file(user_id, file_bin, cloud_file_path, filename)
 
-    return added
+def locate_file(user_id, cloud_file_path, address, backups, file_hash=''):
+    futures = set()
+    for replica in replica_selector.rank([replica for replica in [address] + backups if replica]):
+        futures.add(fan_out_executor.submit(fetch_from_replica, replica, replica != address, user_id, cloud_file_path))
+        location = wait_for_location(futures, replica_selector.get_deadline(), file_hash)
+        if location is not None:
+            return location
+    return wait_for_location(futures, fan_out_timeout, file_hash)
 
 
-def fetch_file(user_id, username, cloud_file_path, local_path_obj):
-    addresses = proxy.get_server_addresses(user_id)
+def receive_from_replicas(replicas, user_id, cloud_file_path, part_path, size, file_hash):
+    address, backup = replicas[0]
+    if size >= stripe_min_size and len(replicas) > 1:
+        chunk_hashes = call_server(address, 'get_chunk_hashes', (user_id, cloud_file_path, backup))
+        if chunk_hashes and receive_striped_file(replicas, user_id, cloud_file_path, part_path, size, file_hash,
+                                                 chunk_hashes):
+            return True
+    return receive_file(address, user_id, cloud_file_path, part_path, size, file_hash, backup)
 
-    flag = False
-    file_bin = None
-    for address in addresses:
-        with ServerProxy(address, allow_none=True) as new_proxy:
-            path_valid, path_exists, rel_path_str = new_proxy.path_check(user_id, cloud_file_path)
 
-            if path_valid and path_exists:
-                flag, file_bin = new_proxy.fetch_file(user_id, cloud_file_path)
+def download_file(user_id, cloud_file_path, address, backups, file_hash=''):
+    location = locate_file(user_id, cloud_file_path, address, backups, file_hash)
+    if location is None:
+        return None
 
-    filename = Path(cloud_file_path).name
+    _, located_address, backup, size, file_hash = location
+    part_path = content_cache.get_part_path(user_id, cloud_file_path, file_hash)
 
-    if not flag:
-        return False
+    replicas = [(located_address, backup)] + [(replica, replica != address) for replica in [address] + backups
+                                              if replica and replica != located_address]
+    if not receive_from_replicas(replicas, user_id, cloud_file_path, part_path, size, file_hash):
+        return None
 
-    with open(str((local_path_obj / filename).resolve()), 'wb') as handle:
-        decrypted = decrypt_file(username, file_bin)
-        try:
-            handle.write(decrypted)
-        except IOError:
-            return False
+    return content_cache.put(user_id, cloud_file_path, file_hash, part_path)
 
-    return True
 
+def fetch_file(user_id, keys, cloud_file_path, local_path_obj):
+    return fetch_located_file(user_id, keys, cloud_file_path, resolve_file(user_id, cloud_file_path),
+                              local_path_obj / Path(cloud_file_path).name)
 
-def get_file_binary(local_path):
-    with open(local_path, 'rb') as file:
-        file_bin = Binary(file.read())
-    return file_bin
 
+def get_cached_file(user_id, cloud_file_path, location):
+    address, file_hash, backups = location
+    if not address and not backups:
+        return None
 
-def decrypt_file(username, file_bin):
-    _, password, salt = proxy.get_user_credentials(username)
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=bytes(salt, 'utf-8'),
-        iterations=100000,
-        backend=default_backend()
-    )
-    pass_as_bytes = bytes(password, 'utf-8')
-    key = base64.urlsafe_b64encode(kdf.derive(pass_as_bytes))
-    f = Fernet(key)
-    decrypted = Binary(f.decrypt(file_bin.data))
+    cached_path = content_cache.get(user_id, cloud_file_path, file_hash)
+    if cached_path is None:
+        cached_path = download_file(user_id, cloud_file_path, address, backups, file_hash)
+    return cached_path
 
-    return decrypted.data
 
+def make_temp_path(dir_path=None):
+    with tempfile.NamedTemporaryFile(dir=dir_path, delete=False) as handle:
+        pass
+    return handle.name
 
-def encrypt_file(username, file_bin):
-    _, password, salt = proxy.get_user_credentials(username)
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=bytes(salt, 'utf-8'),
-        iterations=100000,
-        backend=default_backend()
-    )
-    pass_as_bytes = bytes(password, 'utf-8')
-    key = base64.urlsafe_b64encode(kdf.derive(pass_as_bytes))
-    f = Fernet(key)
-    encrypted = f.encrypt(file_bin.data)
 
-    return encrypted
+def fetch_located_file(user_id, keys, cloud_file_path, location, target_path_obj):
+    cached_path = get_cached_file(user_id, cloud_file_path, location)
+    if cached_path is None:
+        return False
+
+    temp_path = make_temp_path(str(target_path_obj.parent))
+    try:
+        keys.decrypt_file(cached_path, temp_path)
+    except (IOError, ValueError, InvalidTag, InvalidToken):
+        os.remove(temp_path)
+        return False
+
+    os.replace(temp_path, str(target_path_obj.resolve()))
+    return True
+
+
+def retry_transfer(transfer, *params):
+    for attempt in range(transfer_retries):
+        try:
+            if transfer(attempt, *params):
+                return True
+        except (OSError, ProtocolError, Fault):
+            pass
+        time.sleep(busy_backoff * 2 ** attempt)
+    return False
+
+
+def print_progress(label, count, total, failed):
+    print('\r{} {}/{} files, {} failed.'.format(label, count, total, len(failed)), end='' if count < total else '\n',
+          flush=True)
+
+
+def run_transfers(label, transfer, tasks, done, total, failed):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=bulk_transfer_workers) as executor:
+        futures = {executor.submit(retry_transfer, transfer, *params): name for name, params in tasks.items()}
+        for count, future in enumerate(concurrent.futures.as_completed(futures), done + 1):
+            if not future.result():
+                failed.append(futures[future])
+            print_progress(label, count, total, failed)
+    return failed
+
+
+def walk_local_tree(local_dir_path):
+    dir_paths = []
+    file_paths = []
+    for dir_path, _, file_names in os.walk(local_dir_path):
+        rel_dir_path = os.path.relpath(dir_path, local_dir_path)
+        dir_paths.append(rel_dir_path)
+        file_paths += [os.path.normpath(os.path.join(rel_dir_path, file_name)) for file_name in file_names]
+    return dir_paths, file_paths
+
+
+def upload_tree_file(attempt, user_id, encrypted_path, cloud_file_path, location, replica_set):
+    cloud_dir_path, filename = os.path.split(cloud_file_path)
+    if attempt:
+        return upload_file(user_id, encrypted_path, cloud_dir_path, filename)
+    if location[1] and location[1] == hash_file(encrypted_path):
+        return True
+    return upload_to_replicas(user_id, encrypted_path, cloud_dir_path, filename, location, replica_set)
+
+
+def upload_dir(user_id, keys, local_dir_obj, cloud_dir_path):
+    dir_paths, file_paths = walk_local_tree(str(local_dir_obj))
+    cloud_dir_paths = [os.path.normpath(os.path.join(cloud_dir_path, dir_path)) for dir_path in dir_paths]
+    cloud_file_paths = [os.path.normpath(os.path.join(cloud_dir_path, file_path)) for file_path in file_paths]
+    locations, replica_sets = proxy.get_user_group(user_id).call(
+        multi_call, ('resolve_paths', (user_id, cloud_file_paths)), ('get_replica_sets', (user_id, cloud_file_paths)))
+    if len(locations) != len(cloud_file_paths) or len(replica_sets) != len(cloud_file_paths) or \
+            not all(replica_sets):
+        return None
+
+    addresses = {replica_set[0][0] for replica_set in replica_sets} or {proxy.get_next_server()}
+    results = query_servers(addresses, 'make_dir_tree', user_id, cloud_dir_paths)
+    listing_cache.invalidate(user_id)
+    if len(results) != len(addresses) or not all(made for _, made in results):
+        return None
+
+    items = list(zip(file_paths, cloud_file_paths, locations, replica_sets))
+    failed = []
+    for start in range(0, len(items), bulk_batch_size):
+        batch = items[start:start + bulk_batch_size]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            encrypted_paths = [os.path.join(temp_dir, str(index)) for index in range(len(batch))]
+            encrypted = keys.encrypt_files([(str(local_dir_obj / file_path), encrypted_path,
+                                             keys.get_path_salt(cloud_file_path))
+                                            for (file_path, cloud_file_path, _, _), encrypted_path
+                                            in zip(batch, encrypted_paths)])
+
+            tasks = {}
+            for (_, cloud_file_path, location, replica_set), encrypted_path, ok in zip(batch, encrypted_paths,
+                                                                                       encrypted):
+                if ok:
+                    tasks[cloud_file_path] = (user_id, encrypted_path, cloud_file_path, location, replica_set)
+                else:
+                    failed.append(cloud_file_path)
+            done = start + len(batch) - len(tasks)
+            if len(tasks) < len(batch):
+                print_progress('Uploaded', done, len(items), failed)
+            run_transfers('Uploaded', upload_tree_file, tasks, done, len(items), failed)
+    return failed
+
+
+def download_tree_file(attempt, user_id, cloud_file_path, location, cached_paths):
+    if attempt:
+        location = resolve_file(user_id, cloud_file_path)
+    cached_path = get_cached_file(user_id, cloud_file_path, location)
+    if cached_path is None:
+        return False
+    cached_paths[cloud_file_path] = cached_path
+    return True
+
+
+def fetch_tree_file(attempt, user_id, keys, cloud_file_path, location, target_path_obj):
+    if attempt:
+        location = resolve_file(user_id, cloud_file_path)
+    return fetch_located_file(user_id, keys, cloud_file_path, location, target_path_obj)
+
+
+def fetch_dir(user_id, keys, cloud_dir_path, local_dir_obj):
+    cloud_file_paths = proxy.get_tree_paths(user_id, cloud_dir_path)
+    locations = proxy.resolve_paths(user_id, cloud_file_paths) if cloud_file_paths else []
+    if len(locations) != len(cloud_file_paths):
+        return None
+
+    target_dir_obj = local_dir_obj / Path(os.path.normpath(cloud_dir_path)).name
+    items = []
+    for cloud_file_path, location in zip(cloud_file_paths, locations):
+        target_path_obj = target_dir_obj / os.path.relpath(cloud_file_path, cloud_dir_path or os.curdir)
+        items.append((cloud_file_path, location, target_path_obj))
+
+    for target_parent_obj in {item[2].parent for item in items} | {target_dir_obj}:
+        target_parent_obj.mkdir(parents=True, exist_ok=True)
+
+    failed = []
+    for start in range(0, len(items), bulk_batch_size):
+        batch = items[start:start + bulk_batch_size]
+        cached_paths = {}
+        run_transfers('Fetched', download_tree_file,
+                      {cloud_file_path: (user_id, cloud_file_path, location, cached_paths)
+                       for cloud_file_path, location, _ in batch}, start, len(items), failed)
+
+        batch = [item for item in batch if item[0] in cached_paths]
+        temp_paths = [make_temp_path(str(target_path_obj.parent)) for _, _, target_path_obj in batch]
+        decrypted = keys.decrypt_files([(cached_paths[cloud_file_path], temp_path)
+                                        for (cloud_file_path, _, _), temp_path in zip(batch, temp_paths)])
+        for (cloud_file_path, location, target_path_obj), temp_path, ok in zip(batch, temp_paths, decrypted):
+            if ok:
+                os.replace(temp_path, str(target_path_obj.resolve()))
+                continue
+            os.remove(temp_path)
+            if not retry_transfer(fetch_tree_file, user_id, keys, cloud_file_path, location, target_path_obj):
+                failed.append(cloud_file_path)
+    return failed
 
 
 class App(object):
-    def __init__(self, user_id, username):
+    def __init__(self, user_id, username, keys):
         self.user_id = user_id
         self.username = username
+        self.keys = keys
         self.cd = ''
 
     def main_loop(self):
@@ -234,6 +470,8 @@ class App(object):
             print('- upload <file-path> <cloud-path-to-upload> <filename>')
             print('- delete <path-of-file>')
             print('- fetch <path-on-cloud> <local-path-to-save>')
+            print('- upload-dir <dir-path> <cloud-path-to-upload>')
+            print('- fetch-dir <dir-path-on-cloud> <local-path-to-save>')
             print('- exit')
             command = str(input('$ ')).split(' ')
 
@@ -270,9 +508,17 @@ class App(object):
 
                 if can_change:
                     if local_file_path_obj.is_file():
-                        file_bin = encrypt_file(self.username, get_file_binary(str(local_file_path_obj)))
+                        with tempfile.NamedTemporaryFile(delete=False) as handle:
+                            pass
 
-                        if upload_file(self.user_id, file_bin, cloud_file_path, filename):
+                        try:
+                            self.keys.encrypt_file(str(local_file_path_obj), handle.name,
+                                                   self.keys.get_path_salt(str(Path(rel_path) / filename)))
+                            uploaded = upload_file(self.user_id, handle.name, cloud_file_path, filename)
+                        finally:
+                            os.remove(handle.name)
+
+                        if uploaded:
                             print('Uploaded "{}" to "{}" successfully.'.format(filename,
                                                                                self.username + os.sep + rel_path))
                         else:
@@ -295,11 +541,48 @@ class App(object):
                 if not local_path_to_save_obj.is_dir():
                     print('Invalid local directory.')
                 else:
-                    if fetch_file(self.user_id, self.username, cloud_file_path, local_path_to_save_obj):
+                    if fetch_file(self.user_id, self.keys, cloud_file_path, local_path_to_save_obj):
                         print('File saved to {}.'.format(str(local_path_to_save_obj)))
                     else:
                         print('Fetching failed.')
 
+            elif command[0] == 'upload-dir' and len(command) == 3:
+                local_dir_path_obj = Path(command[1].strip()).resolve()
+                cloud_dir_path = os.path.normpath(str(Path(self.cd) / command[2].strip()))
+
+                if not local_dir_path_obj.is_dir():
+                    print('Invalid local directory.')
+                else:
+                    failed = upload_dir(self.user_id, self.keys, local_dir_path_obj, cloud_dir_path)
+
+                    if failed is None:
+                        print('Invalid cloud path.')
+                    elif failed:
+                        print('Could not upload {} files:'.format(len(failed)))
+                        for cloud_file_path in failed:
+                            print('  {}'.format(cloud_file_path))
+                    else:
+                        print('Uploaded "{}" to "{}" successfully.'.format(str(local_dir_path_obj),
+                                                                           self.username + os.sep + cloud_dir_path))
+
+            elif command[0] == 'fetch-dir' and len(command) == 3:
+                cloud_dir_path = os.path.normpath(str(Path(self.cd) / command[1].strip()))
+                local_path_to_save_obj = Path(command[2].strip()).resolve()
+
+                if not local_path_to_save_obj.is_dir():
+                    print('Invalid local directory.')
+                else:
+                    failed = fetch_dir(self.user_id, self.keys, cloud_dir_path, local_path_to_save_obj)
+
+                    if failed is None:
+                        print('Fetching failed.')
+                    elif failed:
+                        print('Could not fetch {} files:'.format(len(failed)))
+                        for cloud_file_path in failed:
+                            print('  {}'.format(cloud_file_path))
+                    else:
+                        print('Directory saved to {}.'.format(str(local_path_to_save_obj)))
+
             elif command[0] == 'exit':
                 break
             else:
@@ -313,7 +596,7 @@ if __name__ == '__main__':
     parser.add_argument('password', help='Password of the user.', type=str)
     args = parser.parse_args()
 
-    proxy = ServerProxy(name_server_url, allow_none=True)
+    proxy = ShardedProxy(name_server_urls)
 
     if args.mode == 'signup':
         sign_up(args.username, args.password)
@@ -1,10 +1,32 @@
 import os
+import time
+import queue
+import shutil
 from pathlib import Path
-import hashlib
 import argparse
-from xmlrpc.server import SimpleXMLRPCServer
-from xmlrpc.client import ServerProxy, Binary
-from config import name_server_url
+import tempfile
+import threading
+from xmlrpc.client import Binary, Fault, ProtocolError
+from config import name_server_urls, chunk_size, file_server_read_workers, file_server_read_queue, \
+    file_server_upload_workers, file_server_upload_queue, registration_batch_size, replication_workers, \
+    replication_retries, replication_backoff, replication_factor, heartbeat_interval, block_gc_interval, \
+    block_gc_grace, delta_block_size, discard_timeout, delta_session_timeout, path_lock_stripes
+from transfer import send_block_list, Throttle
+from block_store import BlockStore
+from delta import make_signatures
+from manifest import Manifest
+from transport import make_server, get_server_url
+from pool import proxy_pool
+from shards import shard_groups, get_shard_group, group_by_shard
+
+deltas = {}
+delta_lock = threading.Lock()
+path_locks = [threading.Lock() for _ in range(path_lock_stripes)]
+replication_queue = queue.Queue()
+
+
+def get_path_lock(path_obj):
+    return path_locks[hash(str(path_obj)) % len(path_locks)]
 
 
 def get_owner_and_backup_info(rel_path_obj):
@@ -18,32 +40,23 @@ def get_owner_and_backup_info(rel_path_obj):
         return -1, 0
 
 
-def hash_file(file_path_for_hash):
-    hash_obj = hashlib.sha256()
-    with open(file_path_for_hash, 'rb') as rbFile:
-        while True:
-            block = rbFile.read(65536)
-            if not block:
-                break
-            hash_obj.update(block)
-    return hash_obj.hexdigest()
-
-
-def get_file_binary(abs_path):
-    with open(abs_path, 'rb') as file:
-        file_bin = Binary(file.read())
-    return file_bin
-
-
 def generate_file_info(server_id, os_file_path, os_file_name):
     file_last_modified = os.path.getmtime(os_file_path)
-    file_hash = hash_file(os_file_path)
+    file_hash = block_store.read_block_list(os_file_path)['hash']
     file_path_rel = Path(os_file_path).relative_to(root_dir)
     whose, is_backup = get_owner_and_backup_info(file_path_rel)
     file_path_str = str(file_path_rel.relative_to(file_path_rel.parts[0]))
     return whose, server_id, file_path_str, os_file_name, is_backup, file_hash, file_last_modified
 
 
+def record_files(added, removed_path_objs):
+    entries = []
+    for path_obj, file_info in added:
+        stat = os.stat(str(path_obj))
+        entries.append((os.path.relpath(str(path_obj), str(root_dir)), stat.st_size, stat.st_mtime_ns, file_info))
+    manifest.update(entries, [os.path.relpath(str(path_obj), str(root_dir)) for path_obj in removed_path_objs])
+
+
 def path_check(user_id, path, backup=False):
     base_dir = root_dir / (str(user_id) + '_backup') if backup else root_dir / str(user_id)
     path_obj = (base_dir / path).resolve()
@@ -55,16 +68,27 @@ def path_check(user_id, path, backup=False):
     return path_valid, path_exists, rel_path_str
 
 
-def check_file_hash(user_id, cloud_file_path, hash_to_check, backup=False):
-    path_valid, path_exists, rel_path_str = path_check(user_id, cloud_file_path)
+def load_block_list(user_id, cloud_file_path, backup=False):
+    path_valid, path_exists, rel_path_str = path_check(user_id, cloud_file_path, backup=backup)
     if not path_valid or not path_exists:
-        return False, 'INVALID'
+        return None
+
     if backup:
         path_obj = (root_dir / (str(user_id) + '_backup') / rel_path_str).resolve()
     else:
         path_obj = (root_dir / str(user_id) / rel_path_str).resolve()
-    hash_of_file = hash_file(str(path_obj))
-    if hash_of_file == hash_to_check:
+
+    if not path_obj.is_file():
+        return None
+
+    return block_store.read_block_list(str(path_obj))
+
+
+def check_file_hash(user_id, cloud_file_path, hash_to_check, backup=False):
+    block_list = load_block_list(user_id, cloud_file_path, backup)
+    if block_list is None:
+        return False, 'INVALID'
+    if block_list['hash'] == hash_to_check and not block_store.get_missing(block_list['blocks']):
         return True, 'MATCHED'
     else:
         return False, 'NOT_MATCHED'
@@ -91,8 +115,19 @@ def make_dirs(user_id, cloud_dir_path):
     return True
 
 
-def delete_file(user_id, cloud_file_path, backup=False):
-    global args
+def make_dir_tree(user_id, cloud_dir_paths):
+    base_dir = root_dir / str(user_id)
+    made = True
+    for cloud_dir_path in cloud_dir_paths:
+        path_valid, path_exists, rel_path_str = path_check(user_id, cloud_dir_path)
+        if not path_valid:
+            made = False
+        elif not path_exists:
+            (base_dir / rel_path_str).mkdir(parents=True, exist_ok=True)
+    return made
+
+
+def discard_file(user_id, cloud_file_path, backup=False):
     path_valid, path_exists, rel_path_str = path_check(user_id, cloud_file_path, backup=backup)
     if not path_valid or not path_exists:
         return False
@@ -100,28 +135,58 @@ def delete_file(user_id, cloud_file_path, backup=False):
         path_obj = (root_dir / (str(user_id) + '_backup') / rel_path_str).resolve()
     else:
         path_obj = (root_dir / str(user_id) / rel_path_str).resolve()
-    if path_obj.is_file():
-        os.remove(str(path_obj))
-    else:
+    block_list = block_store.read_block_list(str(path_obj)) if path_obj.is_file() else None
+    if block_list is None:
         return False
-    if not backup:
-        with ServerProxy(name_server_url, allow_none=True) as name_proxy:
-            addresses = name_proxy.get_file_backup_servers(args.server_id, user_id, rel_path_str)
-        for address in addresses:
-            with ServerProxy(address, allow_none=True) as file_server_proxy:
-                if not file_server_proxy.delete_file(user_id, cloud_file_path, True):
-                    return False
-        with ServerProxy(name_server_url, allow_none=True) as name_proxy:
-            if not name_proxy.remove_file(user_id, rel_path_str):
-                return False
+    os.remove(str(path_obj))
+    block_store.release(block_list['blocks'])
+    record_files([], [path_obj])
     return True
 
 
-def upload_file(user_id, file_bin, cloud_dir_path, filename, backup=False):
+def discard_copy(address, user_id, cloud_file_path, backup):
+    try:
+        with proxy_pool.proxy(address, discard_timeout) as file_server_proxy:
+            file_server_proxy.discard_file(user_id, cloud_file_path, bool(backup))
+        return True
+    except (OSError, Fault, ProtocolError):
+        return False
+
+
+def delete_file(user_id, cloud_file_path, backup=False):
     global args
+    if not discard_file(user_id, cloud_file_path, backup):
+        return False
+    if not backup:
+        _, _, rel_path_str = path_check(user_id, cloud_file_path)
+        name_proxy = get_shard_group(user_id)
+        pending_server_ids = [server_id for server_id, address, is_backup, alive
+                              in name_proxy.get_file_copy_servers(args.server_id, user_id, rel_path_str)
+                              if not alive or not discard_copy(address, user_id, cloud_file_path, is_backup)]
+        if not name_proxy.remove_file(user_id, rel_path_str, pending_server_ids):
+            return False
+    return True
+
+
+def get_missing_blocks(block_hashes):
+    return block_store.get_missing(block_hashes)
+
+
+def put_block(block_bin):
+    return block_store.put(block_bin.data)
+
+
+def commit_blocks(user_id, cloud_dir_path, filename, block_list, backup=False, sync_replication=False):
     path_valid, path_exists, rel_path_str = path_check(user_id, cloud_dir_path)
 
-    if not path_valid:
+    if not path_valid or (not backup and not path_exists):
+        return False
+
+    if not block_store.add_refs(block_list['blocks']):
+        return False
+
+    if not block_store.verify(block_list):
+        block_store.release(block_list['blocks'])
         return False
 
     if backup:
@@ -132,61 +197,316 @@ def upload_file(user_id, file_bin, cloud_dir_path, filename, backup=False):
 
         path_obj = (path_obj / filename).resolve()
     else:
-        if not path_exists:
-            return False
-
         path_obj = (root_dir / str(user_id) / rel_path_str / filename).resolve()
 
-    with open(str(path_obj), 'wb') as handle:
-        handle.write(file_bin.data)
+    with get_path_lock(path_obj):
+        previous = block_store.read_block_list(str(path_obj))
+        block_store.write_block_list(str(path_obj), block_list)
+    if previous is not None:
+        block_store.release(previous['blocks'])
 
-    if not backup:
-        with ServerProxy(name_server_url, allow_none=True) as name_proxy:
-            address = name_proxy.get_next_server()
+    return register_upload(user_id, path_obj, str(Path(rel_path_str) / filename), block_list['hash'], backup,
+                           sync_replication)
 
-        if address == '':
-            return False
 
-        with ServerProxy(address, allow_none=True) as file_server_proxy:
-            if not file_server_proxy.upload_file(user_id, file_bin, cloud_dir_path, filename, True):
+def expire_deltas():
+    now = time.monotonic()
+    with delta_lock:
+        expired = [delta_id for delta_id, session in deltas.items() if now - session[4] > delta_session_timeout]
+        sessions = [deltas.pop(delta_id) for delta_id in expired]
+
+    for session in sessions:
+        try:
+            os.remove(session[3])
+        except OSError:
+            pass
+    return len(sessions)
+
+
+def begin_delta(user_id, cloud_file_path, base_hash):
+    expire_deltas()
+    block_list = load_block_list(user_id, cloud_file_path)
+    if block_list is None or block_list['hash'] != base_hash:
+        return '', Binary(b'')
+
+    _, _, rel_path_str = path_check(user_id, cloud_file_path)
+    fd, temp_path = tempfile.mkstemp(dir=str(block_store.temp_dir))
+    os.close(fd)
+    delta_id = os.path.basename(temp_path)
+    with delta_lock:
+        deltas[delta_id] = (user_id, rel_path_str, block_list, temp_path, time.monotonic())
+    return delta_id, Binary(make_signatures(block_store.read(block_hash) for block_hash in block_list['blocks']))
+
+
+def append_delta(delta_id, ops):
+    with delta_lock:
+        if delta_id not in deltas:
+            return False
+        user_id, rel_path_str, block_list, temp_path, _ = deltas[delta_id]
+        deltas[delta_id] = (user_id, rel_path_str, block_list, temp_path, time.monotonic())
+
+    with open(temp_path, 'ab') as handle:
+        for op in ops:
+            if isinstance(op, Binary):
+                handle.write(op.data)
+            elif 0 <= op * delta_block_size < block_list['size']:
+                handle.write(block_store.read_range(block_list, op * delta_block_size, delta_block_size))
+            else:
                 return False
+    return True
+
+
+def commit_delta(delta_id, file_hash, sync_replication=False):
+    with delta_lock:
+        session = deltas.pop(delta_id, None)
+    if session is None:
+        return False
+
+    user_id, rel_path_str, base_block_list, temp_path, _ = session
+    block_list = block_store.ingest(temp_path)
+    path_obj = (root_dir / str(user_id) / rel_path_str).resolve()
+
+    with get_path_lock(path_obj):
+        committed = block_list['hash'] == file_hash and \
+            block_store.read_block_list(str(path_obj)) == base_block_list
+        if committed:
+            os.replace(temp_path, str(path_obj))
+
+    if not committed:
+        block_store.release(block_list['blocks'])
+        os.remove(temp_path)
+        return False
+
+    block_store.release(base_block_list['blocks'])
+    return register_upload(user_id, path_obj, rel_path_str, file_hash, False, sync_replication)
 
-    with ServerProxy(name_server_url, allow_none=True) as name_proxy:
-        saved = name_proxy.save_file_info([generate_file_info(args.server_id, str(path_obj), filename)])
+
+def register_upload(user_id, path_obj, cloud_file_path, file_hash, backup, sync_replication):
+    global args
+    replication = 'replicated' if backup else 'pending'
+    name_proxy = get_shard_group(user_id)
+    file_info = generate_file_info(args.server_id, str(path_obj), path_obj.name)
+    saved = name_proxy.sync_file_infos(args.server_id, [file_info], [], replication)
+    if saved:
+        record_files([(path_obj, file_info)], [])
+
+    if saved and replication == 'pending':
+        if sync_replication:
+            return run_replication(user_id, cloud_file_path, file_hash, 1) != 'failed'
+        replication_queue.put((user_id, cloud_file_path, file_hash))
 
     return saved
 
 
+def replicate_file(user_id, cloud_file_path, file_hash):
+    path_obj = root_dir / str(user_id) / cloud_file_path
+    block_list = block_store.read_block_list(str(path_obj))
+    if block_list is None or block_list['hash'] != file_hash:
+        return 'replicated'
+
+    name_proxy = get_shard_group(user_id)
+    replica_set = name_proxy.get_replica_set(user_id, cloud_file_path, file_hash)
+
+    for address, present in replica_set:
+        if not present and address != server_url:
+            if not send_block_list(address, user_id, os.path.dirname(cloud_file_path), path_obj.name, block_list,
+                                   lambda index, block_hash: block_store.read(block_hash), True):
+                return None
+
+    return 'replicated' if len(replica_set) >= replication_factor else 'degraded'
+
+
+def run_replication(user_id, cloud_file_path, file_hash, attempts):
+    replication = 'failed'
+    for attempt in range(attempts):
+        try:
+            replication = replicate_file(user_id, cloud_file_path, file_hash) or 'failed'
+        except (OSError, Fault, ProtocolError):
+            pass
+        if replication != 'failed':
+            break
+        time.sleep(replication_backoff * 2 ** attempt)
+
+    try:
+        name_proxy = get_shard_group(user_id)
+        name_proxy.set_replication_state(user_id, cloud_file_path, file_hash, replication)
+    except (OSError, Fault, ProtocolError):
+        pass
+    return replication
+
+
+def copy_file(user_id, cloud_file_path, backup, target_address, bandwidth):
+    block_list = load_block_list(user_id, cloud_file_path, backup)
+    if block_list is None:
+        return -1
+
+    throttle = Throttle(bandwidth)
+    if not send_block_list(target_address, user_id, os.path.dirname(cloud_file_path), os.path.basename(cloud_file_path),
+                           block_list, lambda index, block_hash: throttle.consume(block_store.read(block_hash)), True):
+        return -1
+    return throttle.sent
+
+
+def promote_file(user_id, cloud_file_path, file_hash):
+    block_list = load_block_list(user_id, cloud_file_path, True)
+    if block_list is None or block_list['hash'] != file_hash:
+        return False
+
+    _, _, rel_path_str = path_check(user_id, cloud_file_path)
+    backup_path_obj = (root_dir / (str(user_id) + '_backup') / rel_path_str).resolve()
+    path_obj = (root_dir / str(user_id) / rel_path_str).resolve()
+    path_obj.parent.mkdir(parents=True, exist_ok=True)
+
+    previous = block_store.read_block_list(str(path_obj))
+    os.replace(str(backup_path_obj), str(path_obj))
+    if previous is not None:
+        block_store.release(previous['blocks'])
+
+    file_info = generate_file_info(args.server_id, str(path_obj), path_obj.name)
+    name_proxy = get_shard_group(user_id)
+    promoted = name_proxy.sync_file_infos(args.server_id, [file_info], [(user_id, rel_path_str, 1)], 'degraded')
+    if promoted:
+        record_files([(path_obj, file_info)], [backup_path_obj])
+    return promoted
+
+
+def drop_file(user_id, cloud_file_path, backup, file_hash):
+    global args
+    block_list = load_block_list(user_id, cloud_file_path, backup)
+    if block_list is None or block_list['hash'] != file_hash:
+        return False
+
+    _, _, rel_path_str = path_check(user_id, cloud_file_path, backup=backup)
+    base_dir = root_dir / (str(user_id) + '_backup') if backup else root_dir / str(user_id)
+    path_obj = (base_dir / rel_path_str).resolve()
+    os.remove(str(path_obj))
+    block_store.release(block_list['blocks'])
+    name_proxy = get_shard_group(user_id)
+    dropped = name_proxy.sync_file_infos(args.server_id, [], [(user_id, rel_path_str, int(backup))])
+    if dropped:
+        record_files([], [path_obj])
+    return dropped
+
+
+def demote_file(user_id, cloud_file_path, file_hash):
+    block_list = load_block_list(user_id, cloud_file_path)
+    if block_list is None or block_list['hash'] != file_hash:
+        return False
+
+    _, _, rel_path_str = path_check(user_id, cloud_file_path)
+    path_obj = (root_dir / str(user_id) / rel_path_str).resolve()
+    backup_path_obj = (root_dir / (str(user_id) + '_backup') / rel_path_str).resolve()
+    backup_path_obj.parent.mkdir(parents=True, exist_ok=True)
+
+    previous = block_store.read_block_list(str(backup_path_obj))
+    os.replace(str(path_obj), str(backup_path_obj))
+    if previous is not None:
+        block_store.release(previous['blocks'])
+
+    file_info = generate_file_info(args.server_id, str(backup_path_obj), backup_path_obj.name)
+    name_proxy = get_shard_group(user_id)
+    demoted = name_proxy.sync_file_infos(args.server_id, [file_info], [(user_id, rel_path_str, 0)], 'degraded')
+    if demoted:
+        record_files([(backup_path_obj, file_info)], [path_obj])
+    return demoted
+
+
+def replication_worker():
+    while True:
+        user_id, cloud_file_path, file_hash = replication_queue.get()
+        run_replication(user_id, cloud_file_path, file_hash, replication_retries)
+        replication_queue.task_done()
+
+
+def heartbeat_loop(url, name_group):
+    last_time = time.monotonic()
+    last_reads = read_lane.completed
+    last_writes = upload_lane.completed
+    while True:
+        time.sleep(heartbeat_interval)
+        now = time.monotonic()
+        reads = read_lane.completed
+        writes = upload_lane.completed
+        try:
+            with proxy_pool.proxy(url) as name_proxy:
+                registered = name_proxy.heartbeat(args.server_id, shutil.disk_usage(str(root_dir)).free // (1 << 20),
+                                                  upload_lane.active + replication_queue.qsize(),
+                                                  (reads - last_reads) / (now - last_time),
+                                                  (writes - last_writes) / (now - last_time))
+            if not registered:
+                name_group.register_file_server(args.server_id, server_url)
+        except (OSError, Fault, ProtocolError, OverflowError):
+            pass
+        last_time, last_reads, last_writes = now, reads, writes
+
+
+def block_gc_loop():
+    while True:
+        time.sleep(block_gc_interval)
+        expire_deltas()
+        print('Collected {} unreferenced blocks.'.format(block_store.collect_garbage(block_gc_grace)))
+
+
+def start_replication(server_id):
+    for name_group in shard_groups:
+        for user_id, cloud_file_path, file_hash in name_group.get_unreplicated_files(server_id):
+            replication_queue.put((user_id, cloud_file_path, file_hash))
+
+    for _ in range(replication_workers):
+        threading.Thread(target=replication_worker, daemon=True).start()
+
+
+def read_chunk(user_id, cloud_file_path, offset, length, backup=False):
+    block_list = load_block_list(user_id, cloud_file_path, backup)
+    if block_list is None or offset >= block_list['size']:
+        return Binary(b'')
+
+    return Binary(block_store.read_range(block_list, offset, min(length, chunk_size)))
+
+
+def get_chunk_hashes(user_id, cloud_file_path, backup=False):
+    block_list = load_block_list(user_id, cloud_file_path, backup)
+    if block_list is None:
+        return []
+
+    return block_list['blocks']
+
+
 def fetch_file(user_id, cloud_file_path, backup=False, backup_ord=0):
-    path_valid, path_exists, rel_path_str = path_check(user_id, cloud_file_path)
+    path_valid, path_exists, rel_path_str = path_check(user_id, cloud_file_path, backup=backup)
     if not path_valid or not path_exists:
-        return False, None
+        return False, '', False, 0, ''
 
     if backup:
         path_obj = (root_dir / (str(user_id) + '_backup') / rel_path_str).resolve()
     else:
         path_obj = (root_dir / str(user_id) / rel_path_str).resolve()
 
-    if not path_obj.is_file():
-        return False, None
+    block_list = block_store.read_block_list(str(path_obj)) if path_obj.is_file() else None
+    if block_list is None:
+        return False, '', False, 0, ''
 
-    with ServerProxy(name_server_url, allow_none=True) as name_proxy:
-        hash_info = name_proxy.get_file_hashes(user_id, rel_path_str)
+    name_proxy = get_shard_group(user_id)
+    hash_info = name_proxy.get_file_hashes(user_id, rel_path_str)
+    if not hash_info:
+        return False, '', False, 0, ''
 
-    own_hash_matches, code = check_file_hash(user_id, cloud_file_path, hash_info[backup_ord][0])
+    own_hashes = [file_hash for file_hash, address in hash_info if address == server_url]
+    own_hash_matches, code = check_file_hash(user_id, cloud_file_path,
+                                             own_hashes[0] if own_hashes else hash_info[backup_ord][0], backup)
 
     if own_hash_matches:
-        return True, get_file_binary(str(path_obj))
+        return True, server_url, backup, block_list['size'], block_list['hash']
     else:
         for i in range(1, len(hash_info)):
             file_hash, address = hash_info[i]
-            with ServerProxy(address, allow_none=True) as file_server_proxy:
-                success, binary = file_server_proxy.fetch_file(user_id, cloud_file_path, True, i)
+            with proxy_pool.proxy(address) as file_server_proxy:
+                location = file_server_proxy.fetch_file(user_id, cloud_file_path, True, i)
 
-                if success:
-                    return True, binary
+                if location[0]:
+                    return location
 
-        return False, None
+        return False, '', False, 0, ''
 
 
 def delete_empty_dir(user_id, cloud_dir_path):
@@ -203,6 +523,71 @@ def delete_empty_dir(user_id, cloud_dir_path):
         return False
 
 
+def scan_files(dir_path):
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if not entry.name.startswith('.'):
+                    yield from scan_files(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path, entry.stat(follow_symlinks=False)
+
+
+def sync_shards(file_infos, removal_keys):
+    file_info_groups = group_by_shard(file_infos)
+    removal_key_groups = group_by_shard(removal_keys)
+    for name_group, file_info_group, removal_key_group in zip(shard_groups, file_info_groups, removal_key_groups):
+        if not file_info_group and not removal_key_group:
+            continue
+        if not name_group.sync_file_infos(args.server_id, file_info_group, removal_key_group):
+            return False
+    return True
+
+
+def register_files(manifest):
+    registered = manifest.get_stats()
+    changed = []
+    for file_path, stat in scan_files(str(root_dir)):
+        os_path = os.path.relpath(file_path, str(root_dir))
+        if get_owner_and_backup_info(Path(os_path))[0] == -1:
+            continue
+        if registered.pop(os_path, None) != (stat.st_size, stat.st_mtime_ns):
+            changed.append((os_path, stat))
+    removed = list(registered)
+
+    for index, (os_path, stat) in enumerate(changed):
+        file_path = str(root_dir / os_path)
+        if block_store.read_block_list(file_path) is None:
+            print('Moving file into the block store:', os_path)
+            block_store.ingest(file_path)
+            changed[index] = (os_path, os.stat(file_path))
+
+    for start in range(0, max(len(changed), len(removed)), registration_batch_size):
+        entries = []
+        for os_path, stat in changed[start:start + registration_batch_size]:
+            file_info = generate_file_info(args.server_id, str(root_dir / os_path), os.path.basename(os_path))
+            print('Added file:', file_info)
+            entries.append((os_path, stat.st_size, stat.st_mtime_ns, file_info))
+
+        removed_batch = removed[start:start + registration_batch_size]
+        if not sync_shards([file_info for _, _, _, file_info in entries], manifest.get_removal_keys(removed_batch)):
+            return False
+        manifest.update(entries, removed_batch)
+
+    file_counts = [name_group.get_server_file_count(args.server_id) for name_group in shard_groups]
+    if -1 in file_counts or sum(file_counts) != manifest.count():
+        print('Name server is out of sync, registering all files...')
+        for name_group in shard_groups:
+            if not name_group.clear_server_files(args.server_id):
+                return False
+        for file_infos in manifest.get_file_infos(args.server_id, registration_batch_size):
+            if not sync_shards(file_infos, []):
+                return False
+
+    print('Registered {} changed and {} removed files.'.format(len(changed), len(removed)))
+    return True
+
+
 if __name__ == '__main__':
     root_dir = Path.home() / 'rpc_server_files'
 
@@ -211,21 +596,42 @@ if __name__ == '__main__':
     parser.add_argument('port', help='Port of the file server.', type=int)
     args = parser.parse_args()
 
-    with SimpleXMLRPCServer(('localhost', args.port)) as server:
+    with make_server(('localhost', args.port), threaded=True) as server:
         server.register_function(path_check)
         server.register_function(check_file_hash)
         server.register_function(get_filenames)
         server.register_function(make_dirs)
+        server.register_function(make_dir_tree)
         server.register_function(delete_file)
-        server.register_function(upload_file)
+        server.register_function(get_missing_blocks)
+        server.register_function(put_block)
+        server.register_function(commit_blocks)
+        server.register_function(begin_delta)
+        server.register_function(append_delta)
+        server.register_function(commit_delta)
+        server.register_function(read_chunk)
         server.register_function(fetch_file)
+        server.register_function(get_chunk_hashes)
         server.register_function(delete_empty_dir)
-
-        server_url = 'http://{}:{}'.format(server.server_address[0], server.server_address[1])
-
-        server_registered = False
-        with ServerProxy(name_server_url, allow_none=True) as proxy:
-            server_registered = proxy.register_file_server(args.server_id, server_url)
+        server.register_function(copy_file)
+        server.register_function(promote_file)
+        server.register_function(demote_file)
+        server.register_function(drop_file)
+        server.register_function(discard_file)
+        read_lane = server.add_lane(['path_check', 'check_file_hash', 'get_filenames', 'read_chunk', 'fetch_file',
+                                     'get_chunk_hashes'],
+                                    file_server_read_workers, file_server_read_queue)
+        upload_lane = server.add_lane(['make_dirs', 'make_dir_tree', 'delete_file', 'get_missing_blocks',
+                                       'put_block', 'commit_blocks', 'begin_delta', 'append_delta', 'commit_delta',
+                                       'delete_empty_dir', 'promote_file', 'demote_file', 'drop_file',
+                                       'discard_file'],
+                                      file_server_upload_workers, file_server_upload_queue)
+
+        server_url = get_server_url(server)
+
+        server_registered = True
+        for name_group in shard_groups:
+            server_registered = name_group.register_file_server(args.server_id, server_url) and server_registered
 
         if server_registered:
             root_dir = root_dir / str(args.server_id)
@@ -234,27 +640,25 @@ if __name__ == '__main__':
 
             print('Initializing server for files in "{}"...'.format(str(root_dir)))
 
-            file_list = []
-            for root, dirs, files in os.walk(str(root_dir)):
-                for file_name in files:
-                    file_path = os.path.join(root, file_name)
-                    file_info = generate_file_info(args.server_id, file_path, file_name)
-
-                    if file_info[0] != -1:
-                        print('Added file:', file_info)
-                        file_list.append(file_info)
-
-            files_registered = False
-            with ServerProxy(name_server_url, allow_none=True) as proxy:
-                files_registered = proxy.save_file_info(file_list)
+            block_store = BlockStore(str(root_dir / '.blocks'),
+                                     str(root_dir.parent / '{}.blocks.db'.format(args.server_id)))
+            manifest = Manifest(str(root_dir.parent / '{}.manifest.db'.format(args.server_id)))
+            files_registered = register_files(manifest)
 
             if files_registered:
+                start_replication(args.server_id)
+                for name_group, urls in zip(shard_groups, name_server_urls):
+                    for url in urls:
+                        threading.Thread(target=heartbeat_loop, args=(url, name_group), daemon=True).start()
+                threading.Thread(target=block_gc_loop, daemon=True).start()
                 print('Serving file server on {}.'.format(server.server_address))
                 try:
                     server.serve_forever()
                 except KeyboardInterrupt:
-                    with ServerProxy(name_server_url, allow_none=True) as proxy:
-                        proxy.unregister_file_server(args.server_id)
+                    for name_group in shard_groups:
+                        name_group.unregister_file_server(args.server_id)
+                    block_store.close()
+                    manifest.close()
             else:
                 print('Failed file registration.')
         else:
@@ -0,0 +1,102 @@
+import time
+import uuid
+import hashlib
+import itertools
+from xmlrpc.client import Fault, ProtocolError
+from config import name_server_urls, name_server_timeout, name_server_failover_timeout, name_server_retry_backoff
+from transport import NOT_LEADER_FAULT
+from pool import proxy_pool
+
+username_methods = {'save_user', 'get_user_credentials'}
+write_methods = {'save_user', 'register_file_server', 'unregister_file_server', 'save_file_info', 'sync_file_infos',
+                 'set_replication_state', 'clear_server_files', 'remove_file'}
+user_methods = {'get_server_addresses', 'get_dir_infos', 'get_file_infos', 'get_file_hashes', 'remove_file',
+                'resolve_paths', 'get_replica_set', 'get_replica_sets', 'get_tree_paths', 'set_replication_state'}
+
+
+def get_user_shard(user_id, shard_count):
+    return (user_id - 1) % shard_count
+
+
+def get_username_shard(username, shard_count):
+    return int.from_bytes(hashlib.md5(username.encode('utf-8')).digest()[:8], 'big') % shard_count
+
+
+def call_method(address, name, params):
+    with proxy_pool.proxy(address) as proxy:
+        return getattr(proxy, name)(*params)
+
+
+class ReplicaGroup(object):
+    def __init__(self, addresses):
+        self.addresses = list(addresses)
+        self.leader = 0
+        for address in self.addresses:
+            proxy_pool.set_timeout(address, name_server_timeout)
+
+    def call(self, request, *params):
+        deadline = time.monotonic() + name_server_failover_timeout
+        failures = 0
+        while True:
+            index = self.leader
+            try:
+                return request(self.addresses[index], *params)
+            except (OSError, ProtocolError):
+                failures += 1
+                if failures >= len(self.addresses) and time.monotonic() > deadline:
+                    raise
+                self.leader = (index + 1) % len(self.addresses)
+            except Fault as fault:
+                if fault.faultCode != NOT_LEADER_FAULT or time.monotonic() > deadline:
+                    raise
+                if fault.faultString in self.addresses and fault.faultString != self.addresses[index]:
+                    self.leader = self.addresses.index(fault.faultString)
+                    continue
+                if not fault.faultString:
+                    self.leader = (index + 1) % len(self.addresses)
+            time.sleep(name_server_retry_backoff)
+
+    def __getattr__(self, name):
+        def call(*params):
+            if name in write_methods:
+                return self.call(call_method, 'submit_request', (uuid.uuid4().hex, name, list(params)))
+            return self.call(call_method, name, params)
+        return call
+
+
+shard_groups = [ReplicaGroup(addresses) for addresses in name_server_urls]
+
+
+def get_shard_group(user_id):
+    return shard_groups[get_user_shard(user_id, len(shard_groups))]
+
+
+def group_by_shard(items):
+    groups = [[] for _ in shard_groups]
+    for item in items:
+        groups[get_user_shard(item[0], len(shard_groups))].append(item)
+    return groups
+
+
+class ShardedProxy(object):
+    def __init__(self, addresses):
+        self.groups = [ReplicaGroup(replica_addresses) for replica_addresses in addresses]
+        self.counter = itertools.count()
+
+    def get_user_group(self, user_id):
+        return self.groups[get_user_shard(user_id, len(self.groups))]
+
+    def get_username_group(self, username):
+        return self.groups[get_username_shard(username, len(self.groups))]
+
+    def get_group(self, name, params):
+        if name in username_methods:
+            return self.get_username_group(params[0])
+        if name in user_methods:
+            return self.get_user_group(params[0])
+        return self.groups[next(self.counter) % len(self.groups)]
+
+    def __getattr__(self, name):
+        def call(*params):
+            return getattr(self.get_group(name, params), name)(*params)
+        return call
@@ -0,0 +1,198 @@
+import os
+import mmap
+import time
+import queue
+import hashlib
+import concurrent.futures
+from xmlrpc.client import Binary, Fault, ProtocolError
+from config import chunk_size, transfer_retries, stripe_workers, delta_batch_ops, file_copy_timeout
+from transport import BUSY_FAULT
+from pool import proxy_pool
+from delta import generate_delta
+
+
+class Throttle(object):
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth
+        self.started = time.monotonic()
+        self.sent = 0
+
+    def consume(self, data):
+        self.sent += len(data)
+        delay = self.started + self.sent / self.bandwidth - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        return data
+
+
+def hash_file(file_path_for_hash):
+    hash_obj = hashlib.sha256()
+    with open(file_path_for_hash, 'rb') as rbFile:
+        if os.fstat(rbFile.fileno()).st_size:
+            with mmap.mmap(rbFile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                hash_obj.update(mapped)
+    return hash_obj.hexdigest()
+
+
+def hash_blocks(file_path_for_hash):
+    hash_obj = hashlib.sha256()
+    block_hashes = []
+    with open(file_path_for_hash, 'rb') as rbFile:
+        size = os.fstat(rbFile.fileno()).st_size
+        if size:
+            with mmap.mmap(rbFile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for offset in range(0, size, chunk_size):
+                    block = mapped[offset:offset + chunk_size]
+                    hash_obj.update(block)
+                    block_hashes.append(hashlib.sha256(block).hexdigest())
+    return {'size': size, 'hash': hash_obj.hexdigest(), 'blocks': block_hashes}
+
+
+def send_blocks(proxy, user_id, cloud_dir_path, filename, block_list, read_block, backup, sync_replication):
+    missing = set(proxy.get_missing_blocks(block_list['blocks']))
+    for index, block_hash in enumerate(block_list['blocks']):
+        if block_hash in missing:
+            if proxy.put_block(Binary(read_block(index, block_hash))) != block_hash:
+                return False
+            missing.remove(block_hash)
+
+    return proxy.commit_blocks(user_id, cloud_dir_path, filename, block_list, backup, sync_replication)
+
+
+def send_block_list(address, user_id, cloud_dir_path, filename, block_list, read_block, backup=False,
+                    sync_replication=False):
+    for attempt in range(transfer_retries):
+        try:
+            with proxy_pool.proxy(address, file_copy_timeout if sync_replication else None) as proxy:
+                return send_blocks(proxy, user_id, cloud_dir_path, filename, block_list, read_block, backup,
+                                   sync_replication)
+        except (OSError, ProtocolError):
+            time.sleep(attempt + 1)
+        except Fault as fault:
+            if fault.faultCode != BUSY_FAULT:
+                raise
+            time.sleep(attempt + 1)
+    return False
+
+
+def send_file(address, user_id, local_path, cloud_dir_path, filename, backup=False, sync_replication=False):
+    block_list = hash_blocks(local_path)
+    with open(local_path, 'rb') as handle:
+        return send_block_list(address, user_id, cloud_dir_path, filename, block_list,
+                               lambda index, block_hash: os.pread(handle.fileno(), chunk_size, index * chunk_size),
+                               backup, sync_replication)
+
+
+def send_delta_ops(proxy, delta_id, data, signatures):
+    ops = []
+    literal_size = 0
+    for op in generate_delta(data, signatures):
+        if isinstance(op, int):
+            ops.append(op)
+        else:
+            ops.append(Binary(op))
+            literal_size += len(op)
+        if literal_size >= chunk_size or len(ops) >= delta_batch_ops:
+            if not proxy.append_delta(delta_id, ops):
+                return False
+            ops = []
+            literal_size = 0
+    return not ops or proxy.append_delta(delta_id, ops)
+
+
+def send_delta(address, user_id, local_path, cloud_file_path, base_hash, sync_replication=False):
+    file_hash = hash_file(local_path)
+    try:
+        with proxy_pool.proxy(address, file_copy_timeout if sync_replication else None) as proxy:
+            delta_id, signatures = proxy.begin_delta(user_id, cloud_file_path, base_hash)
+            if not delta_id:
+                return False
+
+            with open(local_path, 'rb') as handle:
+                if os.fstat(handle.fileno()).st_size:
+                    with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        sent = send_delta_ops(proxy, delta_id, mapped, signatures.data)
+                else:
+                    sent = send_delta_ops(proxy, delta_id, b'', signatures.data)
+
+            return sent and proxy.commit_delta(delta_id, file_hash, sync_replication)
+    except (OSError, ProtocolError, Fault):
+        return False
+
+
+def read_block(proxy, user_id, cloud_file_path, offset, backup):
+    return proxy.read_chunk(user_id, cloud_file_path, offset, chunk_size, backup).data
+
+
+def receive_chunks(proxy, user_id, cloud_file_path, part_path, size, backup):
+    with open(part_path, 'ab') as handle:
+        offset = handle.tell()
+        while offset < size:
+            block = read_block(proxy, user_id, cloud_file_path, offset, backup)
+            if not block:
+                break
+            handle.write(block)
+            offset += len(block)
+
+
+def receive_file(address, user_id, cloud_file_path, part_path, size, file_hash, backup=False):
+    for attempt in range(transfer_retries):
+        try:
+            with proxy_pool.proxy(address) as proxy:
+                receive_chunks(proxy, user_id, cloud_file_path, part_path, size, backup)
+            break
+        except (OSError, ProtocolError):
+            time.sleep(attempt + 1)
+        except Fault as fault:
+            if fault.faultCode != BUSY_FAULT:
+                raise
+            time.sleep(attempt + 1)
+
+    if not os.path.exists(part_path) or hash_file(part_path) != file_hash:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return False
+    return True
+
+
+def receive_stripes(address, backup, user_id, cloud_file_path, fd, chunk_hashes, pending):
+    try:
+        with proxy_pool.proxy(address) as proxy:
+            while True:
+                try:
+                    index = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    block = read_block(proxy, user_id, cloud_file_path, index * chunk_size, backup)
+                except BaseException:
+                    pending.put(index)
+                    raise
+                if hashlib.sha256(block).hexdigest() != chunk_hashes[index]:
+                    pending.put(index)
+                    return
+                os.pwrite(fd, block, index * chunk_size)
+    except (OSError, ProtocolError, Fault):
+        return
+
+
+def receive_striped_file(replicas, user_id, cloud_file_path, part_path, size, file_hash, chunk_hashes):
+    pending = queue.Queue()
+    for index in range(len(chunk_hashes)):
+        pending.put(index)
+
+    fd = os.open(part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, size)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(replicas) * stripe_workers) as executor:
+            for address, backup in replicas:
+                for _ in range(stripe_workers):
+                    executor.submit(receive_stripes, address, backup, user_id, cloud_file_path, fd, chunk_hashes,
+                                    pending)
+    finally:
+        os.close(fd)
+
+    if not pending.empty() or hash_file(part_path) != file_hash:
+        os.remove(part_path)
+        return False
+    return True
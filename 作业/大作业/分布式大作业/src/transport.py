@@ -0,0 +1,344 @@
+import socket
+import struct
+import selectors
+import threading
+import socketserver
+from urllib.parse import urlparse
+from xmlrpc.client import ServerProxy, Transport, Binary, Fault
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from config import transport
+
+BUSY_FAULT = 503
+NOT_LEADER_FAULT = 421
+LENGTH = struct.Struct('>I')
+INTEGER = struct.Struct('>q')
+FLOAT = struct.Struct('>d')
+
+
+def encode_value(value, parts):
+    if value is None:
+        parts.append(b'N')
+    elif value is True:
+        parts.append(b'T')
+    elif value is False:
+        parts.append(b'F')
+    elif isinstance(value, int):
+        parts.append(b'i' + INTEGER.pack(value))
+    elif isinstance(value, float):
+        parts.append(b'd' + FLOAT.pack(value))
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        parts.append(b's' + LENGTH.pack(len(data)))
+        parts.append(data)
+    elif isinstance(value, (bytes, bytearray, Binary)):
+        data = value.data if isinstance(value, Binary) else value
+        parts.append(b'b' + LENGTH.pack(len(data)))
+        parts.append(data)
+    elif isinstance(value, (list, tuple)):
+        parts.append(b'l' + LENGTH.pack(len(value)))
+        for item in value:
+            encode_value(item, parts)
+    elif isinstance(value, dict):
+        parts.append(b'm' + LENGTH.pack(len(value)))
+        for key, item in value.items():
+            encode_value(key, parts)
+            encode_value(item, parts)
+    else:
+        raise TypeError('cannot marshal {} objects'.format(type(value)))
+
+
+def decode_value(data, offset):
+    tag = data[offset:offset + 1]
+    offset += 1
+    if tag == b'N':
+        return None, offset
+    elif tag == b'T':
+        return True, offset
+    elif tag == b'F':
+        return False, offset
+    elif tag == b'i':
+        return INTEGER.unpack_from(data, offset)[0], offset + INTEGER.size
+    elif tag == b'd':
+        return FLOAT.unpack_from(data, offset)[0], offset + FLOAT.size
+
+    length = LENGTH.unpack_from(data, offset)[0]
+    offset += LENGTH.size
+    if tag == b's':
+        return str(data[offset:offset + length], 'utf-8'), offset + length
+    elif tag == b'b':
+        return Binary(bytes(data[offset:offset + length])), offset + length
+    elif tag == b'l':
+        items = []
+        for _ in range(length):
+            item, offset = decode_value(data, offset)
+            items.append(item)
+        return items, offset
+    elif tag == b'm':
+        items = {}
+        for _ in range(length):
+            key, offset = decode_value(data, offset)
+            items[key], offset = decode_value(data, offset)
+        return items, offset
+    raise ValueError('unknown type tag {!r}'.format(tag))
+
+
+def encode(value):
+    parts = []
+    encode_value(value, parts)
+    return b''.join(parts)
+
+
+def decode(data):
+    value, _ = decode_value(memoryview(data), 0)
+    return value
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        block = sock.recv(min(size - len(data), 1 << 20))
+        if not block:
+            raise ConnectionResetError('connection closed by peer')
+        data += block
+    return data
+
+
+def send_frame(sock, payload):
+    sock.sendall(LENGTH.pack(len(payload)) + payload)
+
+
+def recv_frame(sock):
+    size = LENGTH.unpack(recv_exactly(sock, LENGTH.size))[0]
+    return recv_exactly(sock, size)
+
+
+class BinaryRPCServer(object):
+    def __init__(self, addr, allow_none=True):
+        self.funcs = {}
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(addr)
+        self.socket.listen(128)
+        self.server_address = self.socket.getsockname()
+        self.selector = selectors.DefaultSelector()
+
+    def register_function(self, function, name=None):
+        self.funcs[name or function.__name__] = function
+        return function
+
+    def register_multicall_functions(self):
+        self.funcs['system.multicall'] = self.system_multicall
+
+    def system_multicall(self, call_list):
+        results = []
+        for call in call_list:
+            try:
+                results.append([self._dispatch(call['methodName'], call['params'])])
+            except Fault as fault:
+                results.append({'faultCode': fault.faultCode, 'faultString': fault.faultString})
+            except Exception as e:
+                results.append({'faultCode': 1, 'faultString': '{}:{}'.format(type(e), e)})
+        return results
+
+    def _dispatch(self, method, params):
+        if method not in self.funcs:
+            raise Fault(1, 'method "{}" is not supported'.format(method))
+        return self.funcs[method](*params)
+
+    def handle_payload(self, payload):
+        try:
+            method, params = decode(payload)
+            return encode([0, self._dispatch(method, params)])
+        except Fault as fault:
+            return encode([1, [fault.faultCode, fault.faultString]])
+        except Exception as e:
+            return encode([1, [1, '{}:{}'.format(type(e), e)]])
+
+    def handle_connection(self, conn):
+        try:
+            send_frame(conn, self.handle_payload(recv_frame(conn)))
+        except OSError:
+            self.selector.unregister(conn)
+            conn.close()
+
+    def serve_forever(self):
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.socket:
+                    conn, _ = self.socket.accept()
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.selector.register(conn, selectors.EVENT_READ)
+                else:
+                    self.handle_connection(key.fileobj)
+
+    def server_close(self):
+        for key in list(self.selector.get_map().values()):
+            if key.fileobj is not self.socket:
+                key.fileobj.close()
+        self.selector.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server_close()
+
+
+class Lane(object):
+    def __init__(self, workers, queue_depth):
+        self.workers = threading.BoundedSemaphore(workers)
+        self.capacity = threading.BoundedSemaphore(workers + queue_depth)
+        self.active = 0
+        self.completed = 0
+        self.lock = threading.Lock()
+
+    def run(self, function, *params):
+        if not self.capacity.acquire(blocking=False):
+            raise Fault(BUSY_FAULT, 'server busy')
+        with self.lock:
+            self.active += 1
+        try:
+            with self.workers:
+                return function(*params)
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.completed += 1
+            self.capacity.release()
+
+
+class LaneDispatchMixin(object):
+    def add_lane(self, methods, workers, queue_depth):
+        lane = Lane(workers, queue_depth)
+        for method in methods:
+            self.lanes[method] = lane
+        return lane
+
+    def _dispatch(self, method, params):
+        if method not in self.lanes:
+            return super()._dispatch(method, params)
+        return self.lanes[method].run(super()._dispatch, method, params)
+
+
+class ThreadingBinaryRPCServer(LaneDispatchMixin, BinaryRPCServer):
+    def __init__(self, addr, allow_none=True):
+        BinaryRPCServer.__init__(self, addr, allow_none)
+        self.lanes = {}
+
+    def serve_connection(self, conn):
+        try:
+            while True:
+                send_frame(conn, self.handle_payload(recv_frame(conn)))
+        except OSError:
+            conn.close()
+
+    def serve_forever(self):
+        while True:
+            conn, _ = self.socket.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.serve_connection, args=(conn, ), daemon=True).start()
+
+
+class KeepAliveRequestHandler(SimpleXMLRPCRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+
+class ThreadingXMLRPCServer(LaneDispatchMixin, socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+    def __init__(self, addr, allow_none=False):
+        SimpleXMLRPCServer.__init__(self, addr, requestHandler=KeepAliveRequestHandler, allow_none=allow_none)
+        self.lanes = {}
+
+
+class _Method(object):
+    def __init__(self, send, name):
+        self.__send = send
+        self.__name = name
+
+    def __getattr__(self, name):
+        return _Method(self.__send, '{}.{}'.format(self.__name, name))
+
+    def __call__(self, *args):
+        return self.__send(self.__name, args)
+
+
+class BinaryServerProxy(object):
+    def __init__(self, uri, allow_none=True, timeout=None):
+        parsed = urlparse(uri)
+        self.__address = (parsed.hostname, parsed.port)
+        self.__timeout = timeout
+        self.__sock = None
+
+    def __request(self, method, params):
+        if self.__sock is None:
+            self.__sock = socket.create_connection(self.__address, self.__timeout)
+            self.__sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            send_frame(self.__sock, encode([method, list(params)]))
+            failed, value = decode(recv_frame(self.__sock))
+        except OSError:
+            self.__close()
+            raise
+        if failed:
+            raise Fault(*value)
+        return value
+
+    def __close(self):
+        if self.__sock is not None:
+            self.__sock.close()
+            self.__sock = None
+
+    def __getattr__(self, name):
+        return _Method(self.__request, name)
+
+    def __call__(self, attr):
+        if attr == 'close':
+            return self.__close
+        raise AttributeError('Attribute {!r} not found'.format(attr))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.__close()
+
+
+class TimeoutTransport(Transport):
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = super().make_connection(host)
+        connection.timeout = self.timeout
+        return connection
+
+
+def ping():
+    return True
+
+
+def connect(uri, timeout=None):
+    if urlparse(uri).scheme == 'tcp':
+        return BinaryServerProxy(uri, allow_none=True, timeout=timeout)
+    return ServerProxy(uri, transport=TimeoutTransport(timeout) if timeout else None, allow_none=True)
+
+
+def make_server(addr, allow_none=False, threaded=False):
+    if transport == 'binary':
+        server = (ThreadingBinaryRPCServer if threaded else BinaryRPCServer)(addr, allow_none=True)
+    elif threaded:
+        server = ThreadingXMLRPCServer(addr, allow_none=allow_none)
+    else:
+        server = SimpleXMLRPCServer(addr, allow_none=allow_none)
+    server.register_function(ping)
+    server.register_multicall_functions()
+    return server
+
+
+def get_server_url(server):
+    scheme = 'tcp' if isinstance(server, BinaryRPCServer) else 'http'
+    return '{}://{}:{}'.format(scheme, server.server_address[0], server.server_address[1])